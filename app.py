@@ -1,13 +1,34 @@
-from flask import Flask, request, render_template_string, render_template, jsonify # Ensure render_template is here
+from flask import Flask, request, render_template_string, render_template, jsonify, Response, g # Ensure render_template is here
 import pandas as pd
+import numpy as np
 import os
+import io
+import copy
+import itertools
+import queue
+import threading
+import time
+import warnings
+from collections import OrderedDict
 import plotly.graph_objects as go
 import plotly.express as px
 import altair as alt
 import folium
+from branca.element import MacroElement # Custom Leaflet script layers for Folium maps
+from jinja2 import Template
 import json
-from statsmodels.tsa.statespace.sarimax import SARIMAX # New import for SARIMAX
-from statsmodels.tsa.holtwinters import ExponentialSmoothing # New import for ExponentialSmoothing
+import sketches # Mergeable quantile (log-bucket) and distinct-count (HyperLogLog) sketches
+import profiling # Sampling profiler for on-demand request profiles
+import forecasting # Forecast models (ETS, SARIMAX, seasonal naive) and rolling-origin backtesting
+from openpyxl import Workbook # Write-only workbooks for streaming XLSX exports
+
+try:
+    # Optional: only needed for Parquet exports and the Parquet dataset cache (pickle is used without it)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
 
 
 
@@ -66,64 +87,1094 @@ nestle_colors = {
     # NEW COLORS FOR FORECAST CHART
     'forecast_historical_line': '#007BFF', # Blue for historical data line
     'forecast_line': '#DC3545', # Red for forecast line
-    'forecast_fill': 'rgba(220,53,69,0.1)' # Light red fill for prediction interval
+    'forecast_fill': 'rgba(220,53,69,0.1)', # Light red fill for prediction interval
+
+    # Period-over-period growth overlays
+    'growth_line': '#28A745', # Green for growth % lines
+    'growth_text': '#333333' # Dark grey for growth % labels
 }
 
 
 app = Flask(__name__, static_folder='assets') # <--- ADD static_folder='assets'
 
-# --- Configuration for Data File ---
+# --- Configuration for Data Files ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-EXCEL_FILE_PATH = os.path.join(BASE_DIR, 'assets', 'data', 'nestle_sales_data.xlsx')
+EXCEL_FILE_PATH = os.path.join(BASE_DIR, 'assets', 'data', 'nestle_sales_data.xlsx') # Workbook of the default dataset
 GEOJSON_FILE_PATH = os.path.join(BASE_DIR, 'assets', 'data', 'australian-states.geojson') # Path to your NEW GeoJSON file
 
-df = None
-geojson_data = None # Initialize geojson_data globally
-
-def load_data():
-    """Loads data from the Excel file into a Pandas DataFrame."""
-    global df
-    try:
-        df = pd.read_excel(EXCEL_FILE_PATH, engine='openpyxl')
-        df['Date'] = pd.to_datetime(df['Date'])
-        df['Month'] = df['Date'].dt.month_name()
-        df['Year'] = df['Date'].dt.year
-        df['Month_Year'] = df['Date'].dt.to_period('M').astype(str) # For monthly trend plotting
-
-
-        print(f"Data loaded successfully from: {EXCEL_FILE_PATH}")
-        print(df.head())
-        print(df.info())
-    except FileNotFoundError:
-        print(f"Error: Excel file not found at {EXCEL_FILE_PATH}")
-        df = pd.DataFrame()
-    except KeyError as ke:
-        print(f"KeyError: A required column was not found in the Excel file: {ke}")
-        print("Please check your Excel column names carefully (case-sensitive) and update app.py if needed.")
-        df = pd.DataFrame()
-    except Exception as e:
-        print(f"An unexpected error occurred while loading data: {e}")
-        df = pd.DataFrame()
-
-def load_geojson_data():
-    """Loads GeoJSON data for Australian states from a local file."""
-    global geojson_data
+# Every dataset is served under /d/<dataset_id>/...; the un-prefixed routes serve DEFAULT_DATASET_ID.
+# More datasets (regions, business units) are added in datasets.json, e.g.
+# {"nz": {"excel": "assets/data/nz_sales.xlsx", "geojson": "assets/data/nz-regions.geojson"}}
+# with paths relative to this file; "geojson" defaults to the Australian states.
+DATASETS_CONFIG_PATH = os.environ.get('DATASETS_CONFIG', os.path.join(BASE_DIR, 'assets', 'data', 'datasets.json'))
+DEFAULT_DATASET_ID = os.environ.get('DEFAULT_DATASET', 'nestle')
+DATASET_MEMORY_BUDGET_MB = float(os.environ.get('DATASET_MEMORY_BUDGET_MB', '1024')) # Loaded datasets beyond this are evicted, least recently used first
+DATASET_CACHE_DIR = os.environ.get('DATASET_CACHE_DIR', os.path.join(BASE_DIR, 'cache', 'datasets')) # Columnar copies of the workbooks, read instead of Excel on reload
+
+def add_derived_columns(frame):
+    """Parses 'Date' and adds the Month/Year/Month_Year helper columns used by the charts."""
+    frame['Date'] = pd.to_datetime(frame['Date'])
+    frame['Month'] = frame['Date'].dt.month_name()
+    frame['Year'] = frame['Date'].dt.year
+    frame['Month_Year'] = frame['Date'].dt.to_period('M').astype(str) # For monthly trend plotting
+    return frame
+
+MONTH_COMPLETE_TOLERANCE_DAYS = 3 # The latest month counts as complete once the data reaches this close to its end
+
+def last_complete_month(frame):
+    """Latest month whose data runs (nearly) to its end: the month before it while the latest month is still partial."""
+    latest = frame['Date'].max()
+    month = latest.to_period('M')
+    return month if (month.end_time - latest).days <= MONTH_COMPLETE_TOLERANCE_DAYS else month - 1
+
+def load_dataset_config():
+    """Dataset ID -> {'excel': path, 'geojson': path}: the built-in default dataset plus any from datasets.json."""
+    config = {DEFAULT_DATASET_ID: {'excel': EXCEL_FILE_PATH, 'geojson': GEOJSON_FILE_PATH}}
+    if os.path.exists(DATASETS_CONFIG_PATH):
+        try:
+            with open(DATASETS_CONFIG_PATH, 'r') as f:
+                for dataset_id, paths in json.load(f).items():
+                    config[dataset_id] = {
+                        'excel': os.path.join(BASE_DIR, paths['excel']),
+                        'geojson': os.path.join(BASE_DIR, paths.get('geojson', GEOJSON_FILE_PATH))
+                    }
+            print(f"Dataset configuration loaded from: {DATASETS_CONFIG_PATH}")
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            print(f"Error reading dataset configuration {DATASETS_CONFIG_PATH}: {e}")
+    return config
+
+def dataset_cache_path(dataset_id):
+    """Columnar cache file of a dataset: Parquet when pyarrow is installed, pickle otherwise."""
+    return os.path.join(DATASET_CACHE_DIR, f"{dataset_id}.parquet" if pa is not None else f"{dataset_id}.pkl")
+
+def write_dataset_cache(frame, path):
+    """Writes the rows (with derived columns) to the columnar cache atomically."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    if path.endswith('.parquet'):
+        frame.to_parquet(tmp_path, index=False)
+    else:
+        frame.to_pickle(tmp_path)
+    os.replace(tmp_path, path)
+
+def load_geojson_data(path):
+    """Loads GeoJSON data (e.g. Australian states) from a local file."""
     try:
-        if os.path.exists(GEOJSON_FILE_PATH):
-            with open(GEOJSON_FILE_PATH, 'r') as f:
+        if os.path.exists(path):
+            with open(path, 'r') as f:
                 geojson_data = json.load(f)
-            print(f"GeoJSON data loaded successfully from: {GEOJSON_FILE_PATH}")
-        else:
-            print(f"ERROR: GeoJSON file not found at {GEOJSON_FILE_PATH}.")
-            print("Please ensure 'my_australian_states.json' is in your 'assets/data/' folder.")
-            geojson_data = {"type": "FeatureCollection", "features": []} # Empty GeoJSON on error
+            print(f"GeoJSON data loaded successfully from: {path}")
+            return geojson_data
+        print(f"ERROR: GeoJSON file not found at {path}.")
+        print("Please ensure 'my_australian_states.json' is in your 'assets/data/' folder.")
     except Exception as e:
         print(f"An error occurred while loading GeoJSON data: {e}")
-        geojson_data = {"type": "FeatureCollection", "features": []} # Empty GeoJSON on error
+    return {"type": "FeatureCollection", "features": []} # Empty GeoJSON on error
+
+class Dataset:
+    """
+    One workbook and everything derived from it (sketches, anomaly scan, backtest,
+    scenario and grid caches). Lives in the dataset LRU; after eviction it is
+    rebuilt from the columnar cache, so only the derived state is recomputed.
+    """
+
+    def __init__(self, dataset_id, excel, geojson):
+        self.id = dataset_id
+        self.excel_path = excel
+        self.geojson_path = geojson
+        self.df = pd.DataFrame()
+        self.geojson_data = None
+        self.source_mtime = None # mtime of the Excel file the rows came from
+        self.appended = False # Rows were appended since the columnar cache was written
+        self.frame_bytes = 0 # Deep memory usage of df, measured on load and append
+        self.size_bytes = 0 # memory_bytes() as of the last load or growth, see DatasetCache.refresh_size()
+        self.evicted = False # Set (under append_lock) once dropped from the LRU; appends then go to the reloaded dataset
+        self.updates = get_update_broadcaster(dataset_id) # Survives eviction, so SSE clients keep their stream
+        self.sketches = None # {'overall': pair, 'dimensions': {column: {member: pair}}}, see new_sketch_pair()
+        self.anomaly_scan = None # Latest scan results, tagged with the data version
+        self.backtest_results = None # Latest leaderboard, tagged with the data version it was computed for
+        self.scenario_base = None # Per-cell baseline forecasts, tagged with the data version they were computed for
+        self.grid_cache = {'data_version': None, 'points': None, 'zooms': {}} # zoom -> binned cells, for one data version
+        self.period_cube = None # Dense month x member arrays for period comparisons, tagged with the data version
+        self.kpis = None # Header KPIs (with their data_version), computed once per version by publish_data_update
+        self.sketch_lock = threading.Lock()
+        self.anomaly_lock = threading.Lock()
+        self.backtest_lock = threading.Lock()
+        self.scenario_lock = threading.Lock()
+        self.grid_lock = threading.Lock()
+        self.append_lock = threading.Lock()
+
+    @property
+    def data_version(self):
+        """Bumped every time the loaded data changes (kept across evictions by the broadcaster)."""
+        return self.updates.version
+
+    def load(self, from_excel=False):
+        """
+        Reads the rows (from the columnar cache when it is at least as new as the Excel
+        file, otherwise from Excel, refreshing the cache) and publishes them with their
+        derived state. If reading or publishing fails, the previous rows, source_mtime and
+        derived state are kept, so the file watcher retries on its next check. Returns True on success.
+        """
+        if self.geojson_data is None:
+            self.geojson_data = load_geojson_data(self.geojson_path)
+        cache_path = dataset_cache_path(self.id)
+        try:
+            source_mtime = os.path.getmtime(self.excel_path)
+            from_cache = not from_excel and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= source_mtime
+            if from_cache:
+                frame = pd.read_parquet(cache_path) if cache_path.endswith('.parquet') else pd.read_pickle(cache_path)
+                print(f"Data for '{self.id}' loaded from cache: {cache_path}")
+            else:
+                frame = add_derived_columns(pd.read_excel(self.excel_path, engine='openpyxl'))
+                print(f"Data loaded successfully from: {self.excel_path}")
+                print(frame.head())
+                print(frame.info())
+            if frame.empty:
+                raise ValueError("the file has no rows")
+            publish_data_update(self, frame)
+        except FileNotFoundError:
+            print(f"Error: Excel file not found at {self.excel_path}")
+        except KeyError as ke:
+            print(f"KeyError: A required column was not found in the Excel file: {ke}")
+            print("Please check your Excel column names carefully (case-sensitive) and update app.py if needed.")
+        except Exception as e:
+            print(f"An unexpected error occurred while loading data for '{self.id}': {e}")
+        else:
+            self.source_mtime = source_mtime
+            self.appended = False
+            self.frame_bytes = int(self.df.memory_usage(deep=True).sum())
+            if not from_cache:
+                self.save_cache()
+            return True
+        if not self.df.empty:
+            print(f"Keeping the previously loaded data of dataset '{self.id}'.")
+        return False
+
+    def save_cache(self):
+        """
+        Writes df to the columnar cache and returns True on success. After a load a failure
+        only costs a slower (Excel) reload later; with appended rows the dataset must stay loaded.
+        """
+        try:
+            write_dataset_cache(self.df, dataset_cache_path(self.id))
+        except Exception as e:
+            print(f"Could not write the columnar cache for dataset '{self.id}': {e}")
+            return False
+        self.appended = False
+        return True
+
+    def memory_bytes(self):
+        """Approximate memory held by the rows and the cached derived arrays."""
+        total = self.frame_bytes
+        grid = self.grid_cache
+        if grid['points'] is not None:
+            total += sum(values.nbytes for values in grid['points'].values())
+        for cells in list(grid['zooms'].values()):
+            total += sum(values.nbytes for values in cells.values())
+        if self.scenario_base is not None:
+            total += self.scenario_base['baseline'].nbytes
+        if self.anomaly_scan is not None:
+            total += int(self.anomaly_scan['anomalies'].memory_usage(deep=True).sum())
+        if self.period_cube is not None:
+            total += sum(array.nbytes for arrays in self.period_cube['dimensions'].values() for array in arrays.values())
+        return total
+
+class DatasetCache:
+    """
+    Loaded datasets by ID, least recently used first. Once their combined memory
+    exceeds the budget the least recently used ones are dropped (the most recently
+    used always stays). Sizes are measured only when a dataset grows (load, append,
+    new grid or scenario cache), not on every request. Datasets with appended rows
+    are written to the columnar cache before they leave the LRU, so a request that
+    reloads them meanwhile cannot miss those rows, and stay loaded if that write fails.
+    Lock order: a dataset's append_lock, then self.lock (never held while writing files).
+    """
 
-with app.app_context():
-    load_data()
-    load_geojson_data()
+    def __init__(self, config, budget_bytes):
+        self.config = config
+        self.budget_bytes = budget_bytes
+        self.datasets = OrderedDict()
+        self.lock = threading.Lock()
+        self.load_locks = {} # Dataset ID -> lock held while it loads, so each dataset loads once
+
+    def get(self, dataset_id):
+        """Returns the loaded dataset, loading it on a miss. Raises KeyError for unknown IDs."""
+        if dataset_id not in self.config:
+            raise KeyError(dataset_id)
+        with self.lock:
+            if dataset_id in self.datasets:
+                self.datasets.move_to_end(dataset_id)
+                return self.datasets[dataset_id]
+            load_lock = self.load_locks.setdefault(dataset_id, threading.Lock())
+        with load_lock:
+            with self.lock:
+                dataset = self.datasets.get(dataset_id)
+            if dataset is None:
+                dataset = Dataset(dataset_id, **self.config[dataset_id])
+                dataset.load()
+                dataset.size_bytes = dataset.memory_bytes()
+                with self.lock:
+                    self.datasets[dataset_id] = dataset
+        self.evict()
+        return dataset
+
+    def refresh_size(self, dataset):
+        """Re-measures a dataset after it grew (call without its append_lock held) and evicts others if needed."""
+        size = dataset.memory_bytes()
+        with self.lock:
+            dataset.size_bytes = size
+            loaded = self.datasets.get(dataset.id) is dataset
+        if loaded:
+            self.evict()
+
+    def eviction_candidate(self, keep=()):
+        """Least recently used dataset to drop while over budget, except those in keep (call with lock held)."""
+        if sum(dataset.size_bytes for dataset in self.datasets.values()) <= self.budget_bytes:
+            return None
+        candidates = [dataset for dataset in list(self.datasets.values())[:-1] if dataset.id not in keep]
+        return candidates[0] if candidates else None
+
+    def evict(self):
+        """Drops least recently used datasets until the rest fit the budget (call without lock held)."""
+        keep = set() # Datasets whose appended rows could not be saved
+        while True:
+            with self.lock:
+                dataset = self.eviction_candidate(keep)
+            if dataset is None:
+                return
+            with dataset.append_lock: # Blocks appends to it until its rows are saved and it is gone
+                if dataset.appended and not dataset.save_cache():
+                    print(f"Keeping dataset '{dataset.id}' loaded: its appended rows are not saved.")
+                    keep.add(dataset.id)
+                    continue
+                with self.lock:
+                    if dataset is not self.eviction_candidate(keep):
+                        continue # Requested again while it was being saved
+                    del self.datasets[dataset.id]
+                dataset.evicted = True
+            print(f"Evicted dataset '{dataset.id}' ({dataset.size_bytes / 2**20:,.1f} MB) to stay within {self.budget_bytes / 2**20:,.0f} MB.")
+
+    def loaded(self):
+        """Snapshot of the currently loaded datasets."""
+        with self.lock:
+            return list(self.datasets.values())
+
+    def stats(self):
+        """Configured datasets with their load state and memory, plus the budget."""
+        with self.lock:
+            loaded = {dataset_id: dataset.size_bytes for dataset_id, dataset in self.datasets.items()}
+        return {
+            "default": DEFAULT_DATASET_ID,
+            "memory_budget_mb": round(self.budget_bytes / 2**20, 1),
+            "memory_used_mb": round(sum(loaded.values()) / 2**20, 1),
+            "datasets": {
+                dataset_id: {"loaded": dataset_id in loaded, "memory_mb": round(loaded.get(dataset_id, 0) / 2**20, 1)}
+                for dataset_id in self.config
+            }
+        }
+
+dataset_cache = DatasetCache(load_dataset_config(), DATASET_MEMORY_BUDGET_MB * 2**20)
+
+@app.url_value_preprocessor
+def pull_dataset_id(endpoint, values):
+    """Takes <dataset_id> out of /d/<dataset_id>/... URLs so the views don't need the argument."""
+    g.dataset_id = values.pop('dataset_id', DEFAULT_DATASET_ID) if values else DEFAULT_DATASET_ID
+
+@app.before_request
+def check_dataset_id():
+    if g.get('dataset_id', DEFAULT_DATASET_ID) not in dataset_cache.config:
+        return jsonify({"error": f"Unknown dataset '{g.dataset_id}'. Use one of: {', '.join(dataset_cache.config)}."}), 404
+
+def current_dataset():
+    """The dataset addressed by the current request (loaded on demand)."""
+    return dataset_cache.get(g.get('dataset_id', DEFAULT_DATASET_ID))
+
+# Backtest worker processes started with 'spawn' (Windows/macOS) re-import this file as
+# '__mp_main__'; they only need forecasting.py, so skip loading the data there.
+IS_WORKER_PROCESS = __name__ == '__mp_main__'
+
+# --- Shared aggregates behind the charts (also used by the export endpoints) ---
+def aggregate_yearly_product_revenue(frame):
+    """Total revenue by year and product (three year sales trend chart)."""
+    return frame.groupby(['Year', 'Product Name'])['Total Revenue'].sum().reset_index()
+
+def aggregate_product_revenue(frame):
+    """Total revenue by product, highest first (total sales revenue by product chart)."""
+    product_revenue = frame.groupby('Product Name')['Total Revenue'].sum().reset_index()
+    return product_revenue.sort_values('Total Revenue', ascending=False)
+
+def aggregate_channel_transactions(frame):
+    """Number of transactions per sales medium (sales transaction by channel chart)."""
+    sales_medium_counts = frame['Sales Medium'].value_counts().reset_index()
+    sales_medium_counts.columns = ['Sales Medium', 'count']
+    return sales_medium_counts.sort_values(by='Sales Medium', ascending=True)
+
+def aggregate_product_medium_share(frame):
+    """Sales count and percentage share of each sales medium within each product."""
+    product_sales = frame.groupby(['Product Name', 'Sales Medium'])['Sales Count'].sum().reset_index()
+    product_sales['Percentage'] = 100 * (product_sales['Sales Count'] / product_sales.groupby('Product Name')['Sales Count'].transform('sum'))
+    product_sales['Percentage'] = product_sales['Percentage'].fillna(0)
+    return product_sales
+
+def aggregate_monthly_revenue(frame):
+    """Total revenue per month, in calendar order (monthly sales trend chart)."""
+    monthly_revenue = frame.groupby('Month_Year')['Total Revenue'].sum().reset_index()
+    monthly_revenue['Date_Sort'] = pd.to_datetime(monthly_revenue['Month_Year'])
+    return monthly_revenue.sort_values('Date_Sort').drop('Date_Sort', axis=1)
+
+def aggregate_location_revenue(frame):
+    """Total revenue per state (sales by location map)."""
+    return frame.groupby('Sales Location')['Total Revenue'].sum().reset_index()
+
+def aggregate_store_cells(frame):
+    """Sales count and revenue per store-map grid cell at STORE_CELLS_EXPORT_ZOOM (store map)."""
+    points = extract_points(frame)
+    if points is None:
+        raise KeyError(f"{POINT_LAT_COLUMN}/{POINT_LON_COLUMN}")
+    return cells_to_table(bin_points(points, STORE_CELLS_EXPORT_ZOOM), STORE_CELLS_EXPORT_ZOOM)
+
+# Dimensions a sales row is broken down by (sketches, scenarios, anomaly series)
+SALES_DIMENSIONS = ['Product Name', 'Sales Location', 'Sales Medium']
+
+# Aggregate name -> function(frame) returning the table behind a chart
+CHART_AGGREGATES = {
+    'yearly_product_revenue': aggregate_yearly_product_revenue,
+    'product_revenue': aggregate_product_revenue,
+    'channel_transactions': aggregate_channel_transactions,
+    'product_medium_share': aggregate_product_medium_share,
+    'monthly_revenue': aggregate_monthly_revenue,
+    'location_revenue': aggregate_location_revenue,
+    'store_cells': aggregate_store_cells,
+}
+
+# --- Live data updates (data version + Server-Sent Events) ---
+DATA_WATCH_INTERVAL = float(os.environ.get('DATA_WATCH_INTERVAL', '10')) # Seconds between checks of the Excel file; 0 disables
+SSE_KEEPALIVE_SECONDS = 15 # Idle clients get a comment line this often so proxies keep the stream open
+
+# Chart ID (the /chart/<id> route) -> aggregates it is drawn from
+CHART_DEPENDENCIES = {
+    'three_year_sales_trend': ['yearly_product_revenue'],
+    'total_sales_revenue_by_product': ['product_revenue'],
+    'sales_transaction_by_channel': ['channel_transactions'],
+    'sales_distribution_by_product_medium': ['product_medium_share'],
+    'monthly_sales_trend': ['monthly_revenue'],
+    'monthly_revenue_forecast_sarimax': ['monthly_revenue'],
+    'sales_by_location_map': ['location_revenue'],
+    'store_map': ['store_cells'],
+}
+
+def compute_kpis(frame):
+    """Calculates the formatted KPI values shown in the dashboard header."""
+    total_revenue = frame['Total Revenue'].sum()
+    average_revenue = frame['Total Revenue'].mean()
+    total_unique_products = frame['Product Name'].nunique() # Number of unique product names
+    total_sales_count = frame['Sales Count'].sum() # Sum of the 'Sales Count' column
+    max_revenue = frame['Total Revenue'].max()
+    min_revenue = frame['Total Revenue'].min()
+
+    return {
+        "total_revenue": f"${total_revenue:,.2f}",
+        "average_revenue": f"${average_revenue:,.2f}",
+        "total_unique_products": f"{total_unique_products:,}",
+        "total_sales_count": f"{total_sales_count:,}",
+        "max_revenue": f"${max_revenue:,.2f}",
+        "min_revenue": f"${min_revenue:,.2f}"
+    }
+
+def fingerprint_aggregates(frame):
+    """Hashes every chart aggregate so changed charts can be detected without comparing tables."""
+    fingerprints = {}
+    for name, aggregate in CHART_AGGREGATES.items():
+        try:
+            table = aggregate(frame)
+            fingerprints[name] = str(pd.util.hash_pandas_object(table, index=False).sum())
+        except KeyError:
+            fingerprints[name] = None
+    return fingerprints
+
+# --- Distribution sketches (quantile and distinct-count KPIs) ---
+SKETCH_RELATIVE_ACCURACY = 0.01 # Quantiles are within 1% of the exact value
+SKETCH_HLL_PRECISION = 12 # 4096 registers, ~1.6% error on distinct counts
+
+def new_sketch_pair():
+    """Revenue quantile sketch plus distinct 'Sales ID' counter for one partition."""
+    return {
+        'revenue': sketches.QuantileSketch(SKETCH_RELATIVE_ACCURACY),
+        'transactions': sketches.HyperLogLog(SKETCH_HLL_PRECISION)
+    }
+
+def update_sketches(state, frame):
+    """
+    Adds rows to the per-member sketches of every dimension, then re-merges the
+    overall sketch from the per-product partitions (sketches combine without rescanning rows).
+    """
+    for column in SALES_DIMENSIONS:
+        members = state['dimensions'].setdefault(column, {})
+        for member, rows in frame.groupby(column, sort=False):
+            pair = members.setdefault(member, new_sketch_pair())
+            pair['revenue'].update(rows['Total Revenue'].to_numpy())
+            pair['transactions'].update(rows['Sales ID'].to_numpy())
+
+    overall = new_sketch_pair()
+    for pair in state['dimensions'][SALES_DIMENSIONS[0]].values():
+        overall['revenue'].merge(pair['revenue'])
+        overall['transactions'].merge(pair['transactions'])
+    state['overall'] = overall
+
+def build_sketches(dataset, frame, new_rows=None):
+    """
+    Sketches for frame: built from scratch, or (when rows were appended) a copy of the
+    dataset's current sketches with only new_rows added. The current sketches are never modified.
+    """
+    with dataset.sketch_lock:
+        current = dataset.sketches
+        if new_rows is not None and current is not None:
+            state = copy.deepcopy(current)
+    if new_rows is None or current is None:
+        state = {'dimensions': {}}
+        update_sketches(state, frame)
+    else:
+        update_sketches(state, new_rows)
+    return state
+
+def summarize_sketch_pair(pair, bins=None):
+    """Quantiles, mean and distinct transactions of one partition (plus a histogram if bins is set)."""
+    revenue = pair['revenue']
+    summary = {
+        "count": revenue.count,
+        "mean": revenue.mean(),
+        "median": revenue.quantile(0.5),
+        "p90": revenue.quantile(0.9),
+        "p99": revenue.quantile(0.99),
+        "distinct_transactions": round(pair['transactions'].estimate())
+    }
+    if bins:
+        edges, counts = revenue.histogram(bins)
+        summary["histogram"] = {"edges": edges, "counts": counts}
+    return summary
+
+def sketch_kpis(dataset):
+    """Formatted median/p90/p99 revenue and distinct transactions, read from the sketches in O(1)."""
+    with dataset.sketch_lock:
+        if dataset.sketches is None:
+            return {}
+        summary = summarize_sketch_pair(dataset.sketches['overall'])
+    return {
+        "median_revenue": f"${summary['median']:,.2f}",
+        "p90_revenue": f"${summary['p90']:,.2f}",
+        "p99_revenue": f"${summary['p99']:,.2f}",
+        "distinct_transactions": f"{summary['distinct_transactions']:,}"
+    }
+
+class DataUpdateBroadcaster:
+    """
+    Holds the latest data update and wakes every waiting client when it changes.
+    The payload is serialized once per version, so fan-out cost does not grow
+    with the number of connected dashboards; idle clients just sleep on the condition.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.version = 0
+        self.message = None
+        self.fingerprints = {} # Aggregate name -> hash of its table at the current version
+        self.publish_lock = threading.Lock() # One publish at a time per dataset
+
+    def publish(self, version, payload):
+        with self.condition:
+            self.version = version
+            self.message = f"id: {version}\nevent: update\ndata: {json.dumps(payload)}\n\n"
+            self.condition.notify_all()
+
+    def wait_for_update(self, seen_version, timeout):
+        """Returns (version, message) newer than seen_version, or None after timeout."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.version > seen_version, timeout=timeout)
+            if self.version > seen_version:
+                return self.version, self.message
+            return None
+
+# Dataset ID -> broadcaster. Kept outside the dataset LRU so versions keep increasing and
+# connected dashboards keep their stream when a dataset is evicted and loaded again.
+update_broadcasters = {}
+broadcasters_lock = threading.Lock()
+
+def get_update_broadcaster(dataset_id):
+    with broadcasters_lock:
+        return update_broadcasters.setdefault(dataset_id, DataUpdateBroadcaster())
+
+def publish_data_update(dataset, frame=None, new_rows=None):
+    """
+    Builds the derived state (sketches, anomaly scan, period cube) for frame (default: the
+    dataset's current rows), then swaps frame and that state into the dataset, bumps its data
+    version and broadcasts the new KPIs together with the IDs of the charts whose underlying
+    aggregates changed. Pass new_rows when rows were appended so sketches update incrementally.
+    If building the state raises, the dataset keeps its previous rows and derived state.
+    """
+    df = dataset.df if frame is None else frame
+    if not isinstance(df, pd.DataFrame) or df.empty:
+        return
+    updates = dataset.updates
+    with updates.publish_lock:
+        version = updates.version + 1
+        sketch_state = build_sketches(dataset, df, new_rows)
+        scan = run_anomaly_scan(df, version)
+        period_cube = build_period_cube(df, version)
+        new_fingerprints = fingerprint_aggregates(df)
+
+        # Everything built: swap the rows and their derived state in
+        dataset.df = df
+        with dataset.sketch_lock:
+            dataset.sketches = sketch_state
+        with dataset.anomaly_lock:
+            dataset.anomaly_scan = scan
+        dataset.period_cube = period_cube
+        print(f"Anomaly scan of '{dataset.id}': {len(scan['anomalies'])} flagged points across {scan['series_scanned']} series.")
+        changed_aggregates = {name for name, value in new_fingerprints.items() if updates.fingerprints.get(name) != value}
+        changed_charts = [chart for chart, aggregates in CHART_DEPENDENCIES.items() if changed_aggregates.intersection(aggregates)]
+        updates.fingerprints = new_fingerprints
+        try:
+            kpis = compute_kpis(df)
+            kpis.update(sketch_kpis(dataset))
+            kpis.update(growth_kpis(dataset))
+        except KeyError as ke:
+            kpis = {"error": f"Missing column for KPI calculation: {ke}"}
+        dataset.kpis = dict(kpis, data_version=version)
+        updates.publish(version, {
+            "dataset": dataset.id,
+            "version": version,
+            "kpis": kpis,
+            "changed_charts": changed_charts
+        })
+        print(f"Dataset '{dataset.id}' version {version} published. Changed charts: {changed_charts}")
+
+def watch_data_file():
+    """Background loop that reloads a loaded dataset when its Excel file changes on disk and publishes the update."""
+    while True:
+        time.sleep(DATA_WATCH_INTERVAL)
+        for dataset in dataset_cache.loaded():
+            try:
+                mtime = os.path.getmtime(dataset.excel_path)
+            except OSError:
+                continue
+            if mtime != dataset.source_mtime:
+                print(f"Detected change in {dataset.excel_path}, reloading dataset '{dataset.id}'.")
+                with dataset.append_lock:
+                    # Keeps the current data (and retries next time) if this fails
+                    reloaded = not dataset.evicted and dataset.load(from_excel=True)
+                if reloaded:
+                    dataset_cache.refresh_size(dataset)
+
+
+# --- Forecast model selection (rolling-origin backtest) ---
+BACKTEST_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'backtest_folds') # Per-fold results of each dataset (<dataset_id>.json), reused across runs
+BACKTEST_HORIZON = 6 # Months forecast from each origin
+BACKTEST_WORKERS = int(os.environ.get('BACKTEST_WORKERS', '0')) or None # Processes for fitting; None = one per CPU
+
+def monthly_revenue_series(frame):
+    """
+    Total revenue per month as a Series with a month-start DatetimeIndex (months without sales
+    are 0), up to the last complete month: a partial latest month would be backtested and
+    fitted as a real collapse in sales, so the forecast starts with that month instead.
+    """
+    series = frame.groupby(pd.Grouper(key='Date', freq='MS'))['Total Revenue'].sum()
+    series = series.asfreq('MS', fill_value=0)
+    complete = series.index.to_period('M') <= last_complete_month(frame)
+    return series[complete] if complete.any() else series
+
+def get_backtest_results(dataset):
+    """Runs (or returns the cached) backtest of every candidate model for the dataset's current data version."""
+    with dataset.backtest_lock:
+        data_version = dataset.data_version
+        if dataset.backtest_results is None or dataset.backtest_results['data_version'] != data_version:
+            results = forecasting.run_backtest(
+                monthly_revenue_series(dataset.df),
+                horizon=BACKTEST_HORIZON,
+                cache_path=os.path.join(BACKTEST_CACHE_DIR, f"{dataset.id}.json"),
+                max_workers=BACKTEST_WORKERS
+            )
+            results['data_version'] = data_version
+            dataset.backtest_results = results
+        return dataset.backtest_results
+
+def select_forecast_model(results):
+    """Returns the spec of the best scored model on the leaderboard, or the default model."""
+    for entry in results['leaderboard']:
+        if entry['mape'] is not None:
+            return entry['spec']
+    return forecasting.DEFAULT_MODEL
+
+# --- What-if scenarios on top of the cached forecast ---
+SCENARIO_HORIZON = 36 # Months, same as the forecast chart
+
+def build_scenario_base(dataset):
+    """
+    Precomputes the baseline forecast for every Product x Location x Medium cell.
+    The total is forecast once with the backtest-selected model and split into cells
+    by each cell's share of its calendar month over the last 12 complete months, so a scenario
+    is pure array arithmetic on a (cells x months) matrix with no model refits.
+    """
+    frame = dataset.df
+    data_version = dataset.data_version
+    series = monthly_revenue_series(frame)
+    model_spec = select_forecast_model(get_backtest_results(dataset))
+    total_forecast = forecasting.forecast_model(model_spec, series, SCENARIO_HORIZON)
+    forecast_index = pd.date_range(start=series.index[-1] + pd.DateOffset(months=1), periods=SCENARIO_HORIZON, freq='MS')
+
+    cell_codes, cells = pd.MultiIndex.from_frame(frame[SALES_DIMENSIONS]).factorize()
+    month_number = (frame['Date'].dt.year * 12 + frame['Date'].dt.month - 1).to_numpy()
+    last_month_number = series.index[-1].year * 12 + series.index[-1].month - 1
+    # The 12 months up to the series' last (complete) month, so a partial month's few rows don't set its shares
+    recent = (month_number > last_month_number - 12) & (month_number <= last_month_number)
+    calendar_month = frame['Date'].dt.month.to_numpy() - 1
+
+    revenue_by_cell_month = np.zeros((len(cells), 12))
+    np.add.at(revenue_by_cell_month, (cell_codes[recent], calendar_month[recent]), frame['Total Revenue'].to_numpy()[recent])
+    month_totals = revenue_by_cell_month.sum(axis=0)
+    # Calendar months without recent sales fall back to each cell's share of the whole year
+    year_share = revenue_by_cell_month.sum(axis=1) / max(revenue_by_cell_month.sum(), 1e-12)
+    shares = np.where(month_totals > 0, revenue_by_cell_month / np.where(month_totals > 0, month_totals, 1), year_share[:, None])
+
+    return {
+        'data_version': data_version,
+        'model': forecasting.model_name(model_spec),
+        'periods': forecast_index,
+        'cells': {dimension: cells.get_level_values(level).to_numpy() for level, dimension in enumerate(SALES_DIMENSIONS)},
+        'baseline': shares[:, forecast_index.month - 1] * total_forecast[None, :] # cells x months
+    }
+
+def get_scenario_base(dataset):
+    """Returns the dataset's cached per-cell baseline, rebuilding it when the data version changes."""
+    with dataset.scenario_lock:
+        rebuilt = dataset.scenario_base is None or dataset.scenario_base['data_version'] != dataset.data_version
+        if rebuilt:
+            dataset.scenario_base = build_scenario_base(dataset)
+        base = dataset.scenario_base
+    if rebuilt:
+        dataset_cache.refresh_size(dataset)
+    return base
+
+def resolve_dimension(name):
+    """Accepts a column name ('Sales Location') or its filter alias ('location')."""
+    column = FILTER_COLUMNS.get(name, name)
+    if column not in SALES_DIMENSIONS:
+        raise ValueError(f"Unknown dimension '{name}'. Use one of: {', '.join(SALES_DIMENSIONS + list(FILTER_COLUMNS))}.")
+    return column
+
+def shock_masks(base, shock):
+    """Boolean masks of the cells and forecast months a shock applies to."""
+    cell_mask = np.ones(base['baseline'].shape[0], dtype=bool)
+    if shock.get('dimension') is not None:
+        values = shock.get('value', shock.get('values'))
+        values = values if isinstance(values, list) else [values]
+        cell_mask = np.isin(base['cells'][resolve_dimension(shock['dimension'])], values)
+    periods = base['periods']
+    month_mask = np.ones(len(periods), dtype=bool)
+    if shock.get('start'):
+        month_mask &= periods >= pd.Timestamp(shock['start'])
+    if shock.get('end'):
+        month_mask &= periods <= pd.Timestamp(shock['end'])
+    return cell_mask, month_mask
+
+def apply_scenario(base, shocks):
+    """
+    Applies shocks in order to the baseline cell forecasts and returns the scenario matrix.
+    Multiplicative shocks scale the matching cells by 'factor'. Additive shocks add
+    'amount' per month to the matching slice, split across its cells by their current level.
+    """
+    scenario = base['baseline'].copy()
+    for shock in shocks:
+        cell_mask, month_mask = shock_masks(base, shock)
+        shock_type = shock.get('type', 'multiplicative')
+        if shock_type == 'multiplicative':
+            scenario[np.ix_(cell_mask, month_mask)] *= float(shock['factor'])
+        elif shock_type == 'additive':
+            block = scenario[np.ix_(cell_mask, month_mask)]
+            block_totals = block.sum(axis=0)
+            weights = np.where(block_totals != 0, block / np.where(block_totals != 0, block_totals, 1), 1 / max(block.shape[0], 1))
+            scenario[np.ix_(cell_mask, month_mask)] = block + float(shock['amount']) * weights
+        else:
+            raise ValueError(f"Unknown shock type '{shock_type}'. Use 'multiplicative' or 'additive'.")
+    return scenario
+
+# --- Store map (server-side grid aggregation of point data) ---
+POINT_LAT_COLUMN = 'Latitude' # Store/postcode coordinates; optional columns in the Excel file
+POINT_LON_COLUMN = 'Longitude'
+GRID_CELL_PIXELS = 32 # Cell edge on screen, so the number of cells in view is about the same at every zoom
+GRID_MAX_ZOOM = 18
+STORE_CELLS_EXPORT_ZOOM = 8 # Zoom used for the 'store_cells' aggregate (exports, change detection)
+
+def cells_per_world(zoom):
+    """Number of grid cells across the Web Mercator world at this zoom (256px tiles)."""
+    return (256 // GRID_CELL_PIXELS) * 2 ** zoom
+
+def project_points(lat, lon):
+    """Web Mercator x/y of each point in world units [0, 1], y growing southwards like map tiles."""
+    lat = np.clip(lat, -85.05112878, 85.05112878)
+    sin_lat = np.sin(np.radians(lat))
+    x = (np.asarray(lon, dtype=float) + 180.0) / 360.0
+    y = 0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)
+    return x, y
+
+def grid_row_latitude(iy, n):
+    """Latitude of the northern edge of grid row iy (inverse Web Mercator)."""
+    return np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(iy, dtype=float) / n))))
+
+def has_coordinates(frame):
+    """True if the rows have the optional coordinate columns behind the store map."""
+    return POINT_LAT_COLUMN in frame.columns and POINT_LON_COLUMN in frame.columns
+
+def extract_points(frame):
+    """Projected coordinates and revenue of every row with valid coordinates, or None if the data has none."""
+    if not has_coordinates(frame):
+        return None
+    lat = pd.to_numeric(frame[POINT_LAT_COLUMN], errors='coerce').to_numpy(dtype=float)
+    lon = pd.to_numeric(frame[POINT_LON_COLUMN], errors='coerce').to_numpy(dtype=float)
+    valid = np.isfinite(lat) & np.isfinite(lon) & (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+    x, y = project_points(lat[valid], lon[valid])
+    return {
+        'x': x,
+        'y': y,
+        'lat': lat[valid],
+        'lon': lon[valid],
+        'revenue': frame['Total Revenue'].to_numpy(dtype=float)[valid]
+    }
+
+def bin_points(points, zoom):
+    """Bins points into the square grid of this zoom; returns per-cell arrays (one entry per non-empty cell)."""
+    n = cells_per_world(zoom)
+    ix = np.clip((points['x'] * n).astype(np.int64), 0, n - 1)
+    iy = np.clip((points['y'] * n).astype(np.int64), 0, n - 1)
+    cell_ids, inverse = np.unique(ix * n + iy, return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(cell_ids))
+    return {
+        'ix': cell_ids // n,
+        'iy': cell_ids % n,
+        'count': counts,
+        'revenue': np.bincount(inverse, weights=points['revenue'], minlength=len(cell_ids)),
+        'center_lat': np.bincount(inverse, weights=points['lat'], minlength=len(cell_ids)) / counts,
+        'center_lon': np.bincount(inverse, weights=points['lon'], minlength=len(cell_ids)) / counts
+    }
+
+def get_grid_cells(dataset, zoom):
+    """Binned cells for this zoom, cached per zoom for the dataset's current data version (None without coordinates)."""
+    grid_cache = dataset.grid_cache
+    with dataset.grid_lock:
+        if grid_cache['data_version'] != dataset.data_version:
+            grid_cache.update(data_version=dataset.data_version, points=extract_points(dataset.df), zooms={})
+        if grid_cache['points'] is None:
+            return None
+        binned = zoom not in grid_cache['zooms']
+        if binned:
+            grid_cache['zooms'][zoom] = bin_points(grid_cache['points'], zoom)
+        cells = grid_cache['zooms'][zoom]
+    if binned:
+        dataset_cache.refresh_size(dataset)
+    return cells
+
+def wrap_longitudes(west, east):
+    """
+    Bounding box longitudes moved into [-180, 180] (maps report e.g. east=200 after panning
+    past the antimeridian); a box crossing it then has west > east, one of 360 degrees or more spans the world.
+    """
+    if east - west >= 360:
+        return -180.0, 180.0
+    return (west + 180) % 360 - 180, 180 - (180 - east) % 360
+
+def cells_in_bbox(cells, zoom, west, south, east, north):
+    """Subset of cells overlapping the bounding box (handles boxes crossing the antimeridian)."""
+    n = cells_per_world(zoom)
+    (x_west, x_east), (y_north, y_south) = project_points(np.array([north, south]), np.array([west, east]))
+    ix_min, ix_max = int(x_west * n), int(x_east * n)
+    iy_min, iy_max = int(y_north * n), int(y_south * n)
+    if west <= east:
+        in_x = (cells['ix'] >= ix_min) & (cells['ix'] <= ix_max)
+    else:
+        in_x = (cells['ix'] >= ix_min) | (cells['ix'] <= ix_max)
+    mask = in_x & (cells['iy'] >= iy_min) & (cells['iy'] <= iy_max)
+    return {key: values[mask] for key, values in cells.items()}
+
+def cells_to_table(cells, zoom):
+    """Cell bounds, centroid, count and revenue as a DataFrame."""
+    n = cells_per_world(zoom)
+    return pd.DataFrame({
+        'south': grid_row_latitude(cells['iy'] + 1, n),
+        'west': cells['ix'] / n * 360 - 180,
+        'north': grid_row_latitude(cells['iy'], n),
+        'east': (cells['ix'] + 1) / n * 360 - 180,
+        'center_lat': cells['center_lat'],
+        'center_lon': cells['center_lon'],
+        'count': cells['count'],
+        'revenue': cells['revenue']
+    })
+
+class GridCellLayer(MacroElement):
+    """Leaflet layer that fetches the grid cells in view from /geo/cells whenever the map moves."""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function () {
+            var map = {{ this._parent.get_name() }};
+            var layer = L.layerGroup().addTo(map);
+            var colors = {{ this.colors | tojson }};
+            function mix(a, b, t) {
+                var ca = parseInt(a.slice(1), 16), cb = parseInt(b.slice(1), 16);
+                var r = Math.round(((ca >> 16) & 255) * (1 - t) + ((cb >> 16) & 255) * t);
+                var g = Math.round(((ca >> 8) & 255) * (1 - t) + ((cb >> 8) & 255) * t);
+                var bl = Math.round((ca & 255) * (1 - t) + (cb & 255) * t);
+                return 'rgb(' + r + ',' + g + ',' + bl + ')';
+            }
+            function colorFor(t) {
+                return t < 0.5 ? mix(colors[0], colors[1], t * 2) : mix(colors[1], colors[2], (t - 0.5) * 2);
+            }
+            function refresh() {
+                var b = map.getBounds();
+                var bbox = [b.getWest(), b.getSouth(), b.getEast(), b.getNorth()].join(',');
+                fetch({{ this.url | tojson }} + '?zoom=' + map.getZoom() + '&bbox=' + bbox)
+                    .then(function (response) { return response.json(); })
+                    .then(function (data) {
+                        layer.clearLayers();
+                        var cells = data.cells;
+                        if (!cells || !cells.count) { return; }
+                        var maxRevenue = Math.max.apply(null, cells.revenue.concat([1]));
+                        for (var i = 0; i < cells.count.length; i++) {
+                            var t = Math.sqrt(cells.revenue[i] / maxRevenue);
+                            // Cells come back in [-180, 180]; draw each in the world copy in view
+                            var offset = 360 * Math.ceil((b.getWest() - cells.center_lon[i]) / 360);
+                            L.rectangle([[cells.south[i], cells.west[i] + offset], [cells.north[i], cells.east[i] + offset]], {
+                                color: colorFor(t), weight: 1, fillColor: colorFor(t), fillOpacity: 0.6
+                            }).bindTooltip(cells.count[i].toLocaleString() + ' sales<br>$' +
+                                Math.round(cells.revenue[i]).toLocaleString()).addTo(layer);
+                        }
+                    })
+                    .catch(function (error) { console.error('Error loading store map cells:', error); });
+            }
+            map.on('moveend', refresh);
+            refresh();
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, url, colors):
+        super().__init__()
+        self._name = 'GridCellLayer'
+        self.url = url
+        self.colors = colors
+
+# --- Anomaly detection across every Product x Location x Medium monthly series ---
+ANOMALY_Z_THRESHOLD = 3.5 # Robust z-score beyond which a month is flagged
+ANOMALY_MIN_ABS_CHANGE = 100.0 # Ignore deviations smaller than this many dollars (noise in tiny series)
+ANOMALY_RECENT_MONTHS = 3 # Charts highlight series flagged in the last N months
+ANOMALY_HIGHLIGHT_TOP = 5 # ...and outline at most this many of them, largest |z| first
+ANOMALY_SEASONAL_WEIGHT = 0.5 # Baseline = weight * seasonal (same month last year) + (1 - weight) * trailing median
+ANOMALY_TRAILING_MONTHS = 6
+
+def build_series_cube(frame):
+    """
+    Monthly revenue of every Product x Location x Medium series as a dense
+    (series x months) array, built with one bincount over all rows.
+    """
+    series_codes, series = pd.MultiIndex.from_frame(frame[SALES_DIMENSIONS]).factorize()
+    month_number = (frame['Date'].dt.year * 12 + frame['Date'].dt.month - 1).to_numpy()
+    first_month = month_number.min()
+    n_months = month_number.max() - first_month + 1
+    flat_index = series_codes * n_months + (month_number - first_month)
+    cube = np.bincount(flat_index, weights=frame['Total Revenue'].to_numpy(dtype=float),
+                       minlength=len(series) * n_months).reshape(len(series), n_months)
+    months = pd.period_range(pd.Period(year=first_month // 12, month=first_month % 12 + 1, freq='M'), periods=n_months, freq='M')
+    return cube, series, months
+
+def seasonal_baselines(cube):
+    """
+    Expected value of every series/month from earlier months only: the trailing median
+    of the last ANOMALY_TRAILING_MONTHS months, blended with last year's same month
+    (scaled by the year-over-year change of the 3 months before) once a year of history exists.
+    NaN where there is not enough history.
+    """
+    n_series, n_months = cube.shape
+    window = ANOMALY_TRAILING_MONTHS
+    padded = np.concatenate([np.full((n_series, window), np.nan), cube], axis=1)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window, axis=1)[:, :n_months] # windows[:, t] = months t-window..t-1
+    enough_history = np.sum(~np.isnan(windows), axis=2) >= 3
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # All-NaN windows at the start of the series
+        trailing = np.where(enough_history, np.nanmedian(windows, axis=2), np.nan)
+
+    baseline = trailing.copy()
+    if n_months > 15:
+        cumulative = np.concatenate([np.zeros((n_series, 1)), np.cumsum(cube, axis=1)], axis=1)
+        t = np.arange(15, n_months)
+        recent = cumulative[:, t] - cumulative[:, t - 3] # months t-3..t-1
+        year_ago = cumulative[:, t - 12] - cumulative[:, t - 15] # months t-15..t-13
+        level_ratio = np.clip(np.where(year_ago > 0, recent / np.where(year_ago > 0, year_ago, 1), 1.0), 0.25, 4.0)
+        seasonal = cube[:, t - 12] * level_ratio
+        baseline[:, t] = ANOMALY_SEASONAL_WEIGHT * seasonal + (1 - ANOMALY_SEASONAL_WEIGHT) * trailing[:, t]
+    return baseline
+
+def robust_z_scores(cube, baseline):
+    """
+    Residuals scaled by each series' median absolute deviation. Intermittent series
+    (mostly empty months) have a MAD of 0, so they fall back to the mean absolute
+    deviation, and every scale is floored to avoid dividing by ~0.
+    """
+    residual = cube - baseline
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # Series without any baseline
+        center = np.nanmedian(residual, axis=1, keepdims=True)
+        deviation = np.abs(residual - center)
+        mad_scale = 1.4826 * np.nanmedian(deviation, axis=1, keepdims=True)
+        mean_ad_scale = 1.2533 * np.nanmean(deviation, axis=1, keepdims=True)
+        floor = 0.05 * np.nanmean(np.abs(cube), axis=1, keepdims=True) + 1.0
+    scale = np.fmax(np.where(mad_scale > 0, mad_scale, mean_ad_scale), floor)
+    return residual / scale, residual
+
+def run_anomaly_scan(frame, data_version):
+    """Scores every complete series/month at once and returns the flagged points, largest |z| first."""
+    cube, series, months = build_series_cube(frame)
+    # Leave out a partial latest month: its low totals would flag nearly every series as a drop
+    complete = months <= last_complete_month(frame)
+    cube, months = cube[:, complete], months[complete]
+    baseline = seasonal_baselines(cube)
+    z, residual = robust_z_scores(cube, baseline)
+    flagged = (np.abs(np.nan_to_num(z)) >= ANOMALY_Z_THRESHOLD) & (np.abs(np.nan_to_num(residual)) >= ANOMALY_MIN_ABS_CHANGE)
+    series_index, month_index = np.nonzero(flagged)
+    order = np.argsort(-np.abs(z[series_index, month_index]), kind='stable')
+    series_index, month_index = series_index[order], month_index[order]
+
+    anomalies = pd.DataFrame({
+        dimension: series.get_level_values(level).to_numpy()[series_index]
+        for level, dimension in enumerate(SALES_DIMENSIONS)
+    })
+    anomalies['Month'] = months.strftime('%Y-%m').to_numpy()[month_index]
+    anomalies['Actual'] = cube[series_index, month_index].round(2)
+    anomalies['Baseline'] = baseline[series_index, month_index].round(2)
+    anomalies['Z'] = z[series_index, month_index].round(2)
+    anomalies['Direction'] = np.where(residual[series_index, month_index] < 0, 'drop', 'spike')
+    return {
+        'data_version': data_version,
+        'series_scanned': len(series),
+        'months_scanned': len(months),
+        'months': months,
+        'anomalies': anomalies
+    }
+
+def recent_anomalies(dataset, top_n=None):
+    """
+    Flagged points in the last ANOMALY_RECENT_MONTHS scanned months, largest |z| first,
+    optionally only the first `top_n` (empty if no scan has run).
+    """
+    with dataset.anomaly_lock:
+        scan = dataset.anomaly_scan
+    if scan is None or not len(scan['months']):
+        return pd.DataFrame(columns=SALES_DIMENSIONS + ['Month', 'Actual', 'Baseline', 'Z', 'Direction'])
+    recent_months = scan['months'][-ANOMALY_RECENT_MONTHS:].strftime('%Y-%m')
+    anomalies = scan['anomalies']
+    anomalies = anomalies[anomalies['Month'].isin(recent_months)]
+    return anomalies if top_n is None else anomalies.head(top_n)
+
+# --- Period-over-period comparisons (MoM, YoY, YTD, trailing 12 months) ---
+COMPARISON_METRICS = {'revenue': 'Total Revenue', 'count': 'Sales Count'} # ?metric= -> column summed per month
+COMPARISON_KINDS = ['mom', 'yoy', 'ytd', 'ttm']
+
+def build_period_cube(frame, data_version):
+    """
+    Monthly revenue and sales count of the overall total and of every member of each
+    dimension as dense (members x months) arrays, one bincount per dimension and metric.
+    Months without sales are 0, so comparisons are plain shifts along the month axis.
+    'last_complete_month' is where the KPIs and /compare start, so a partial latest
+    month is not reported as a collapse in sales.
+    """
+    month_number = (frame['Date'].dt.year * 12 + frame['Date'].dt.month - 1).to_numpy()
+    first_month = month_number.min()
+    n_months = month_number.max() - first_month + 1
+    month_offset = month_number - first_month
+    dimensions = {}
+    for column in ['overall'] + SALES_DIMENSIONS:
+        if column == 'overall':
+            codes, members = np.zeros(len(frame), dtype=np.int64), np.array(['Total'], dtype=object)
+        else:
+            # Blank cells become their own (NaN) member instead of code -1, which bincount rejects
+            codes, members = pd.factorize(frame[column], sort=True, use_na_sentinel=False)
+        flat_index = codes * n_months + month_offset
+        dimensions[column] = {'members': np.asarray(members, dtype=object)}
+        for metric, value_column in COMPARISON_METRICS.items():
+            dimensions[column][metric] = np.bincount(flat_index, weights=frame[value_column].to_numpy(dtype=float),
+                                                     minlength=len(members) * n_months).reshape(len(members), n_months)
+    months = pd.period_range(pd.Period(year=first_month // 12, month=first_month % 12 + 1, freq='M'), periods=n_months, freq='M')
+    return {
+        'data_version': data_version,
+        'months': months,
+        'last_complete_month': max(last_complete_month(frame), months[0]), # The only month, even if partial
+        'dimensions': dimensions
+    }
+
+def shift_months(values, months):
+    """values moved `months` later along the month axis, NaN where there is no earlier month."""
+    shifted = np.full(values.shape, np.nan)
+    if months < values.shape[1]:
+        shifted[:, months:] = values[:, :values.shape[1] - months]
+    return shifted
+
+def period_comparisons(values, months):
+    """
+    Current value, comparison value, delta and % change of every member and month, as
+    (members x months) arrays: month over month, year over year, year to date against the
+    same months last year, and trailing 12 months against the 12 months before.
+    """
+    n_months = values.shape[1]
+    cumulative = np.cumsum(values, axis=1)
+    # Year to date = cumulative total minus the cumulative total at the end of the previous year
+    previous_year_end = np.arange(n_months) - (months.month.to_numpy() - 1) - 1
+    ytd = cumulative - np.where(previous_year_end >= 0, cumulative[:, np.maximum(previous_year_end, 0)], 0.0)
+    ttm = np.full(values.shape, np.nan) # Needs 12 months of history
+    if n_months >= 12:
+        ttm[:, 11:] = cumulative[:, 11:] - np.concatenate([np.zeros((values.shape[0], 1)), cumulative[:, :-12]], axis=1)
+
+    comparisons = {}
+    for kind, current, previous in [('mom', values, shift_months(values, 1)),
+                                    ('yoy', values, shift_months(values, 12)),
+                                    ('ytd', ytd, shift_months(ytd, 12)),
+                                    ('ttm', ttm, shift_months(ttm, 12))]:
+        delta = current - previous
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pct = np.where(previous != 0, 100 * delta / np.abs(previous), np.nan)
+        comparisons[kind] = {'current': current, 'previous': previous, 'delta': delta, 'pct': pct}
+    return comparisons
+
+def growth_kpis(dataset):
+    """Formatted MoM/YoY/YTD/TTM revenue growth of the last complete month, read from the period cube."""
+    cube = dataset.period_cube
+    if cube is None:
+        return {}
+    comparisons = period_comparisons(cube['dimensions']['overall']['revenue'], cube['months'])
+    t = cube['months'].get_loc(cube['last_complete_month'])
+    kpis = {"growth_month": cube['last_complete_month'].strftime('%Y-%m')}
+    for kind in COMPARISON_KINDS:
+        pct = comparisons[kind]['pct'][0, t]
+        kpis[f"{kind}_revenue_growth"] = f"{pct:+.1f}%" if np.isfinite(pct) else "N/A"
+    return kpis
+
+def yearly_growth(dataset, column):
+    """
+    Revenue growth of each member of `column` per calendar year against the year before
+    (the year-to-date comparison at each year's last month, at most the last complete month,
+    so a partial latest year is compared with the same months of the previous year), as a
+    [Year, column, 'YoY Growth'] table.
+    """
+    cube = dataset.period_cube
+    comparisons = period_comparisons(cube['dimensions'][column]['revenue'], cube['months'])
+    years = cube['months'].year.to_numpy()
+    year_ends = np.flatnonzero(np.append(years[1:] != years[:-1], True)) # Last month index of every year
+    # The latest year ends at the last complete month (a year without one drops out as a duplicate)
+    year_ends = np.unique(np.minimum(year_ends, cube['months'].get_loc(cube['last_complete_month'])))
+    pct = comparisons['ytd']['pct'][:, year_ends] # members x years
+    members = cube['dimensions'][column]['members']
+    return pd.DataFrame({
+        'Year': np.tile(years[year_ends], len(members)),
+        column: np.repeat(members, len(year_ends)),
+        'YoY Growth': pct.ravel() / 100
+    })
 
 # --- Helper function for rendering chart HTML ---
 def render_chart_template(chart_html, title="Chart"):
@@ -184,8 +1235,11 @@ def render_chart_template(chart_html, title="Chart"):
 # --- Flask Routes ---
 
 @app.route('/') # <--- ADD THIS BLOCK
+@app.route('/d/<dataset_id>/')
 def index():
-    return render_template('index.html')
+    # Charts, KPIs and the event stream of the dashboard come from the dataset in the URL
+    dataset_prefix = '' if request.path == '/' else f"/d/{g.dataset_id}"
+    return render_template('index.html', dataset_prefix=dataset_prefix)
 
 # Define the common Plotly config for responsiveness
 PLOTLY_CONFIG = {
@@ -195,16 +1249,26 @@ PLOTLY_CONFIG = {
 
 # CENTER CHART
 @app.route('/chart/three_year_sales_trend')
+@app.route('/d/<dataset_id>/chart/three_year_sales_trend')
 def three_year_sales_trend_chart():
     """
     Generates an Altair bar chart showing three-year sales trends by product.
     This version is non-interactive but includes tooltips.
     """
+    dataset = current_dataset()
+    df = dataset.df
     if df.empty:
         return "<h1>Data not loaded or unavailable.</h1>", 500
 
     # Aggregate total revenue by year and product name
-    grouped_df = df.groupby(['Year', 'Product Name'])['Total Revenue'].sum().reset_index()
+    grouped_df = aggregate_yearly_product_revenue(df)
+
+    # Add each bar's growth over the previous year (?compare=yoy)
+    compare = request.args.get('compare')
+    if compare:
+        if compare != 'yoy':
+            return "<div>Error: Only ?compare=yoy is available for the yearly chart.</div>", 400
+        grouped_df = grouped_df.merge(yearly_growth(dataset, 'Product Name'), on=['Year', 'Product Name'], how='left')
 
     # Create the base chart with common encodings
     base = alt.Chart(grouped_df).encode(
@@ -232,9 +1296,19 @@ def three_year_sales_trend_chart():
 
     )
 
+    layers = [bars, value_text]
+
+    # Label each bar with its growth over the previous year
+    if compare:
+        growth_text = base.mark_text(align='center', baseline='bottom', dy=-2, fontSize=8).encode(
+            text=alt.Text('YoY Growth:Q', format='+.0%'),
+            color=alt.value(nestle_colors['growth_text'])
+        ).transform_filter('isValid(datum["YoY Growth"])')
+        layers.append(growth_text)
+
     # Layer the bar chart and value labels
     # Removed .interactive() method
-    layered_chart = alt.layer(bars, value_text).properties(
+    layered_chart = alt.layer(*layers).properties(
         width=alt.Step(17.5), # Use alt.Step for width in faceted charts to control individual facet width
         height=175
     )
@@ -255,15 +1329,15 @@ def three_year_sales_trend_chart():
 
 # UPPER RIGHT CHART
 @app.route('/chart/total_sales_revenue_by_product')
+@app.route('/d/<dataset_id>/chart/total_sales_revenue_by_product')
 def total_sales_revenue_by_product_data():
+    dataset = current_dataset()
+    df = dataset.df
     if df.empty:
         return "<div>Error: Data not loaded or available.</div>", 500
 
-    # Group by 'Product Name' (corrected from 'Product') and sum 'Total Revenue'
-    product_revenue = df.groupby('Product Name')['Total Revenue'].sum().reset_index()
-
-    # Sort in descending order of 'Total Revenue'
-    product_revenue = product_revenue.sort_values('Total Revenue', ascending=False)
+    # Sum 'Total Revenue' per 'Product Name', sorted in descending order
+    product_revenue = aggregate_product_revenue(df)
 
     # Define the custom color scheme
     color_scheme = ['#0A477D', '#0F68BD', '#0E6BB8', '#1068C2', '#0C69BD', '#0D69BD', '#1069B5', '#0B6BC1', '#9ED2FA']
@@ -300,6 +1374,12 @@ def total_sales_revenue_by_product_data():
     # Set text color to black for better visibility if needed (text_auto usually handles this well)
     fig.update_traces(textfont_color='black')
 
+    # Outline products behind the strongest anomalous state/channel series of recent months (?anomalies=0 to hide)
+    if request.args.get('anomalies', '1') != '0':
+        flagged_products = set(recent_anomalies(dataset, ANOMALY_HIGHLIGHT_TOP)['Product Name'])
+        fig.for_each_trace(lambda trace: trace.update(marker_line_color=nestle_colors['forecast_line'], marker_line_width=3)
+                           if trace.name in flagged_products else None)
+
 
     return fig.to_html(full_html=False, default_height='100%', default_width='100%')
 
@@ -308,7 +1388,10 @@ def total_sales_revenue_by_product_data():
 from flask import request # Make sure to import request
 
 @app.route('/chart/sales_transaction_by_channel')
+@app.route('/d/<dataset_id>/chart/sales_transaction_by_channel')
 def sales_transaction_by_channel_chart():
+    dataset = current_dataset()
+    df = dataset.df
     print(f"DEBUG: Entering sales_transaction_by_channel_chart.")
     print(f"DEBUG: Type of df at start of function: {type(df)}")
     print(f"DEBUG: Is df empty? {df.empty if isinstance(df, pd.DataFrame) else 'Not a DataFrame'}")
@@ -326,15 +1409,11 @@ def sales_transaction_by_channel_chart():
             return "<div>Error: 'Sales Medium' column not found in data.</div>", 500
 
         print(f"DEBUG: Type of df['Sales Medium'] before value_counts: {type(df['Sales Medium'])}")
-        # Calculate the value counts and reset the index to create a DataFrame
-        sales_medium_counts = df['Sales Medium'].value_counts().reset_index()
+        # Calculate the value counts as a ['Sales Medium', 'count'] DataFrame,
+        # sorted by 'Sales Medium' to ensure consistent color mapping and display order
+        sales_medium_counts = aggregate_channel_transactions(df)
         print("DEBUG: sales_medium_counts created.")
         print(f"DEBUG: sales_medium_counts head:\n{sales_medium_counts.head()}")
-        print(f"DEBUG: Unique Sales Medium values in sales_medium_counts: {sales_medium_counts['Sales Medium'].unique().tolist()}")
-
-        # Rename the columns for clarity
-        sales_medium_counts.columns = ['Sales Medium', 'count']
-        print("DEBUG: sales_medium_counts columns renamed.")
 
         # Define the color scale for 'Online' and 'Direct'
         color_map = {
@@ -342,9 +1421,7 @@ def sales_transaction_by_channel_chart():
             'Direct': '#064885'
         }
 
-        # Prepare data for go.Pie, ensuring order
-        # Sort by 'Sales Medium' to ensure consistent color mapping and display order
-        sales_medium_counts = sales_medium_counts.sort_values(by='Sales Medium', ascending=True)
+        # Prepare data for go.Pie
 
         labels = sales_medium_counts['Sales Medium'].tolist()
         values = sales_medium_counts['count'].tolist()
@@ -408,25 +1485,21 @@ def sales_transaction_by_channel_chart():
         return f"<div>Error generating Sales Transaction by Channel chart: {e}</div>", 500
 
 @app.route('/chart/sales_distribution_by_product_medium')
+@app.route('/d/<dataset_id>/chart/sales_distribution_by_product_medium')
 def sales_distribution_by_product_medium_chart():
     """
     Generates a stacked horizontal bar chart showing the percentage distribution
     of sales by product medium for each product.
     """
+    dataset = current_dataset()
+    df = dataset.df
     if not isinstance(df, pd.DataFrame) or df.empty:
         return "<div>Error: Data not loaded or available for Sales Distribution by Product Medium.</div>", 500
 
     try:
-        # Step 1: Process the data
-        # Group by product and sales medium to get the sales count for each.
-        product_sales = df.groupby(['Product Name', 'Sales Medium'])['Sales Count'].sum().reset_index()
-
-        # Step 2: Calculate the percentage of sales for each medium within each product
-        # We use transform('sum') to get the total sales per product, which allows for a clean percentage calculation.
-        product_sales['Percentage'] = 100 * (product_sales['Sales Count'] / product_sales.groupby('Product Name')['Sales Count'].transform('sum'))
-
-        # Fill NaN values with 0 for products that may have sales in only one medium.
-        product_sales['Percentage'] = product_sales['Percentage'].fillna(0)
+        # Step 1 & 2: Sales count per product and sales medium, plus the percentage
+        # of each medium within each product (see aggregate_product_medium_share)
+        product_sales = aggregate_product_medium_share(df)
 
         # Step 3: Set a specific order for products on the Y-axis to match the desired presentation
         product_order = [
@@ -509,10 +1582,13 @@ def sales_distribution_by_product_medium_chart():
         return f"<div>Error generating Sales Distribution by Product Medium chart: {e}</div>", 500
 
 @app.route('/chart/monthly_sales_trend')
+@app.route('/d/<dataset_id>/chart/monthly_sales_trend')
 def monthly_sales_trend_chart():
     """
     Generates a line chart showing the monthly sales trend.
     """
+    dataset = current_dataset()
+    df = dataset.df
     print(f"DEBUG: Entering monthly_sales_trend_chart.")
     print(f"DEBUG: Type of df at start of function: {type(df)}")
     print(f"DEBUG: Is df empty? {df.empty if isinstance(df, pd.DataFrame) else 'Not a DataFrame'}")
@@ -528,9 +1604,7 @@ def monthly_sales_trend_chart():
 
     try:
         # Data processing
-        monthly_revenue = df.groupby('Month_Year')['Total Revenue'].sum().reset_index()
-        monthly_revenue['Date_Sort'] = pd.to_datetime(monthly_revenue['Month_Year'])
-        monthly_revenue = monthly_revenue.sort_values('Date_Sort').drop('Date_Sort', axis=1)
+        monthly_revenue = aggregate_monthly_revenue(df)
 
         # Create the line chart
         fig_monthly_line = px.line(monthly_revenue,
@@ -553,6 +1627,40 @@ def monthly_sales_trend_chart():
             fillcolor=nestle_colors['monthly_trend_fill_color'] # Light blue fill with transparency
         )
 
+        # Mark recent months in which any product/state/channel series was anomalous (?anomalies=0 to hide)
+        if request.args.get('anomalies', '1') != '0' and dataset.anomaly_scan is not None:
+            flagged_per_month = recent_anomalies(dataset).groupby('Month').size()
+            flagged_months = monthly_revenue[monthly_revenue['Month_Year'].isin(flagged_per_month.index)]
+            fig_monthly_line.add_trace(go.Scatter(
+                x=flagged_months['Month_Year'],
+                y=flagged_months['Total Revenue'],
+                mode='markers',
+                marker=dict(size=10, color='rgba(0,0,0,0)', line=dict(width=2, color=nestle_colors['forecast_line'])),
+                customdata=flagged_per_month.reindex(flagged_months['Month_Year']).to_numpy(),
+                hovertemplate='%{x}<br>%{customdata} anomalous series<extra></extra>',
+                showlegend=False
+            ))
+
+        # Overlay revenue growth on a secondary axis (?compare=mom|yoy|ytd|ttm)
+        compare = request.args.get('compare')
+        if compare:
+            if compare not in COMPARISON_KINDS:
+                return f"<div>Error: Unknown comparison '{compare}'. Use one of: {', '.join(COMPARISON_KINDS)}.</div>", 400
+            cube = dataset.period_cube
+            growth = period_comparisons(cube['dimensions']['overall']['revenue'], cube['months'])[compare]['pct'][0]
+            complete = cube['months'] <= cube['last_complete_month'] # A partial latest month would plot as a collapse
+            fig_monthly_line.add_trace(go.Scatter(
+                x=cube['months'][complete].strftime('%Y-%m'),
+                y=growth[complete],
+                yaxis='y2',
+                mode='lines',
+                line=dict(width=1.5, dash='dot', color=nestle_colors['growth_line']),
+                hovertemplate=f'%{{x}}<br>{compare.upper()} growth: %{{y:+.1f}}%<extra></extra>',
+                showlegend=False
+            ))
+            fig_monthly_line.update_layout(yaxis2=dict(overlaying='y', side='right', ticksuffix='%', showgrid=False,
+                                                       zeroline=True, zerolinecolor=nestle_colors['zero_line_color']))
+
         # Apply layout and theme
         fig_monthly_line.update_layout(
             title=dict(text='Monthly Sales Trend', x=0.5), # Centered title
@@ -584,42 +1692,65 @@ def monthly_sales_trend_chart():
         return f"<div>Error generating Monthly Sales Trend chart: {e}</div>", 500
 
 @app.route('/kpi_data')
+@app.route('/d/<dataset_id>/kpi_data')
 def kpi_data():
     """
-    Calculates and returns Key Performance Indicator (KPI) data.
+    Returns the Key Performance Indicator (KPI) data: totals, sketch quantiles and growth of
+    the last complete month, computed once per data version when the data is published.
     """
-    if df.empty:
+    dataset = current_dataset()
+    kpis = dataset.kpis
+    if dataset.df.empty or kpis is None:
+        return jsonify({"error": "Data not loaded or available for KPIs."}), 500
+    if "error" in kpis:
+        return jsonify({"error": kpis["error"]}), 500
+    # data_version lets the dashboard subscribe to /events from this version
+    return jsonify(dict(kpis, dataset=dataset.id))
+
+@app.route('/kpi/distribution')
+@app.route('/d/<dataset_id>/kpi/distribution')
+def kpi_distribution():
+    """
+    Revenue distribution KPIs from the sketches: count, mean, median, p90, p99,
+    distinct transactions and a histogram, overall and per member of ?dimension=
+    (product, location or medium). ?bins= sets the histogram resolution (default 20).
+    """
+    dataset = current_dataset()
+    if dataset.sketches is None:
         return jsonify({"error": "Data not loaded or available for KPIs."}), 500
 
     try:
-        total_revenue = df['Total Revenue'].sum()
-        average_revenue = df['Total Revenue'].mean()
-        total_unique_products = df['Product Name'].nunique() # Number of unique product names
-        total_sales_count = df['Sales Count'].sum() # Sum of the 'Sales Count' column
-        max_revenue = df['Total Revenue'].max()
-        min_revenue = df['Total Revenue'].min()
-
-        kpis = {
-            "total_revenue": f"${total_revenue:,.2f}",
-            "average_revenue": f"${average_revenue:,.2f}",
-            "total_unique_products": f"{total_unique_products:,}",
-            "total_sales_count": f"{total_sales_count:,}",
-            "max_revenue": f"${max_revenue:,.2f}",
-            "min_revenue": f"${min_revenue:,.2f}"
-        }
-        return jsonify(kpis)
-    except KeyError as ke:
-        return jsonify({"error": f"Missing column for KPI calculation: {ke}"}), 500
-    except Exception as e:
-        return jsonify({"error": f"An error occurred during KPI calculation: {e}"}), 500
+        bins = int(request.args.get('bins', 20))
+        if not 1 <= bins <= 500:
+            raise ValueError("bins must be between 1 and 500")
+    except ValueError as e:
+        return jsonify({"error": f"Invalid bins: {e}"}), 400
+    dimension = request.args.get('dimension')
+    column = FILTER_COLUMNS.get(dimension, dimension)
+    if column is not None and column not in SALES_DIMENSIONS:
+        return jsonify({"error": f"Unknown dimension '{dimension}'. Use one of: {', '.join(FILTER_COLUMNS)}."}), 400
+
+    with dataset.sketch_lock:
+        result = {"data_version": dataset.data_version, "overall": summarize_sketch_pair(dataset.sketches['overall'], bins)}
+        if column:
+            result["dimension"] = column
+            result["members"] = {
+                str(member): summarize_sketch_pair(pair, bins)
+                for member, pair in dataset.sketches['dimensions'][column].items()
+            }
+    return jsonify(result)
 
 @app.route('/chart/monthly_revenue_forecast_sarimax')
+@app.route('/d/<dataset_id>/chart/monthly_revenue_forecast_sarimax')
 def monthly_revenue_forecast_sarimax_chart():
     """
-    Generates a monthly revenue forecast chart using Exponential Smoothing model.
-    Includes historical data, forecasted data, and a 95% prediction interval.
+    Generates a monthly revenue forecast chart using the model that won the
+    rolling-origin backtest (see /forecast/leaderboard).
+    Includes historical data, forecasted data, and a prediction interval.
     """
-    print(f"DEBUG: Entering monthly_revenue_forecast_sarimax_chart (Exponential Smoothing version).")
+    dataset = current_dataset()
+    df = dataset.df
+    print(f"DEBUG: Entering monthly_revenue_forecast_sarimax_chart.")
     print(f"DEBUG: Type of df at start of function: {type(df)}")
     print(f"DEBUG: Is df empty? {df.empty if isinstance(df, pd.DataFrame) else 'Not a DataFrame'}")
     if isinstance(df, pd.DataFrame) and not df.empty:
@@ -636,21 +1767,19 @@ def monthly_revenue_forecast_sarimax_chart():
 
     try:
         # Aggregate total revenue by month (start of month)
-        monthly_revenue = df.groupby(pd.Grouper(key='Date', freq='MS'))['Total Revenue'].sum().reset_index()
-        monthly_revenue.columns = ['Date', 'Total Revenue']
-        monthly_revenue = monthly_revenue.set_index('Date') # Set Date as index for time series models
+        series = monthly_revenue_series(df)
+        monthly_revenue = series.to_frame('Total Revenue') # Date index for time series models
 
-        # Fit an Exponential Smoothing model
-        # Using seasonal='add' for additive seasonality and seasonal_periods=12
-        model = ExponentialSmoothing(monthly_revenue['Total Revenue'], seasonal='add', seasonal_periods=12)
-        results = model.fit()
+        # Pick the best model from the backtest (falls back to additive-seasonal ETS)
+        model_spec = select_forecast_model(get_backtest_results(dataset))
+        print(f"DEBUG: Forecasting with {forecasting.model_name(model_spec)}.")
 
         # Forecast for the next 36 months (3 years)
         forecast_periods = 36
         forecast_index = pd.date_range(start=monthly_revenue.index[-1] + pd.DateOffset(months=1), periods=forecast_periods, freq='MS')
-        forecast_values = results.forecast(steps=forecast_periods)
+        forecast_values = forecasting.forecast_model(model_spec, series, forecast_periods)
 
-        # Exponential Smoothing does not directly provide prediction intervals like SARIMAX's conf_int()
+        # Not every candidate model provides prediction intervals like SARIMAX's conf_int()
         # For simplicity and to match the previous structure, we'll create dummy bounds or skip them if not critical.
         # If prediction intervals are critical, a more complex implementation or a different model might be needed.
         # For now, we'll use a simplified approach to generate bounds for visualization purposes.
@@ -698,7 +1827,7 @@ def monthly_revenue_forecast_sarimax_chart():
         
         # Combine the layers
         chart = alt.layer(historical_line, forecast_line, prediction_interval).properties(
-            title='Monthly Revenue Forecast (Exponential Smoothing)',
+            title=f'Monthly Revenue Forecast ({forecasting.model_name(model_spec)})',
             width='container', # Make chart responsive to container width
             height=200
         ).interactive() # Make the chart interactive (zoom, pan)
@@ -712,13 +1841,190 @@ def monthly_revenue_forecast_sarimax_chart():
         print(f"DEBUG: An error occurred during monthly_revenue_forecast_sarimax_chart generation: {e}")
         return f"<div>Error generating Monthly Revenue Forecast chart: {e}</div>", 500
 
+@app.route('/forecast/leaderboard')
+@app.route('/d/<dataset_id>/forecast/leaderboard')
+def forecast_leaderboard():
+    """
+    Returns the rolling-origin backtest leaderboard (MAPE/RMSE per candidate model)
+    and the model the forecast chart uses.
+    """
+    dataset = current_dataset()
+    df = dataset.df
+    if not isinstance(df, pd.DataFrame) or df.empty:
+        return jsonify({"error": "Data not loaded or available for forecasting."}), 500
+
+    try:
+        results = get_backtest_results(dataset)
+        return jsonify({
+            "data_version": results['data_version'],
+            "horizon": results['horizon'],
+            "origins": results['origins'],
+            "selected_model": forecasting.model_name(select_forecast_model(results)),
+            "leaderboard": results['leaderboard']
+        })
+    except Exception as e:
+        return jsonify({"error": f"An error occurred during forecast backtesting: {e}"}), 500
+
+@app.route('/anomalies')
+@app.route('/d/<dataset_id>/anomalies')
+def anomalies_feed():
+    """
+    Ranked feed of anomalous months across every Product x Location x Medium series
+    (largest robust z-score first). Optional filters: ?direction=drop|spike,
+    ?since=YYYY-MM, ?product=/?location=/?medium=, and ?limit= (default 50).
+    """
+    dataset = current_dataset()
+    with dataset.anomaly_lock:
+        scan = dataset.anomaly_scan
+    if scan is None:
+        return jsonify({"error": "Data not loaded or available for anomaly detection."}), 500
+
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"error": "'limit' must be an integer."}), 400
+    anomalies = scan['anomalies']
+    if request.args.get('direction'):
+        anomalies = anomalies[anomalies['Direction'] == request.args['direction']]
+    if request.args.get('since'):
+        anomalies = anomalies[anomalies['Month'] >= request.args['since']]
+    for param, column in FILTER_COLUMNS.items():
+        values = request.args.getlist(param)
+        if values:
+            anomalies = anomalies[anomalies[column].isin(values)]
+
+    return jsonify({
+        "data_version": scan['data_version'],
+        "threshold": ANOMALY_Z_THRESHOLD,
+        "series_scanned": scan['series_scanned'],
+        "months_scanned": scan['months_scanned'],
+        "total_flagged": len(anomalies),
+        "anomalies": anomalies.head(limit).to_dict('records')
+    })
+
+@app.route('/compare')
+@app.route('/d/<dataset_id>/compare')
+def compare_periods():
+    """
+    Period-over-period comparison of one month (?month=YYYY-MM, default the last complete one) for
+    the total or every member of ?dimension= (product, location or medium): value against
+    the previous month (mom), the same month last year (yoy), year to date against the same
+    months last year (ytd) and trailing 12 months against the 12 months before (ttm).
+    ?metric=revenue|count, and ?product=/?location=/?medium= limit the members returned.
+    """
+    dataset = current_dataset()
+    cube = dataset.period_cube
+    if cube is None:
+        return jsonify({"error": "Data not loaded or available for comparisons."}), 500
+
+    metric = request.args.get('metric', 'revenue')
+    if metric not in COMPARISON_METRICS:
+        return jsonify({"error": f"Unknown metric '{metric}'. Use one of: {', '.join(COMPARISON_METRICS)}."}), 400
+    try:
+        column = resolve_dimension(request.args['dimension']) if request.args.get('dimension') else 'overall'
+        month = pd.Period(request.args['month'], freq='M') if request.args.get('month') else cube['last_complete_month']
+    except ValueError as e:
+        return jsonify({"error": f"Invalid dimension or month: {e}"}), 400
+    if month not in cube['months']:
+        return jsonify({"error": f"No data for {month}. Months run from {cube['months'][0]} to {cube['months'][-1]}."}), 400
+
+    arrays = cube['dimensions'][column]
+    comparisons = period_comparisons(arrays[metric], cube['months'])
+    t = cube['months'].get_loc(month)
+    rows = np.arange(len(arrays['members']))
+    param = next((param for param, filter_column in FILTER_COLUMNS.items() if filter_column == column), None)
+    if param and request.args.getlist(param):
+        rows = rows[np.isin(arrays['members'], request.args.getlist(param))]
+    rows = rows[np.argsort(-arrays[metric][rows, t], kind='stable')] # Largest members first
+
+    def rounded(value, digits=2):
+        return round(float(value), digits) if np.isfinite(value) else None
+
+    members = []
+    for row in rows:
+        member = {"member": str(arrays['members'][row]), "value": rounded(arrays[metric][row, t])}
+        for kind in COMPARISON_KINDS:
+            values = comparisons[kind]
+            member[kind] = {
+                "current": rounded(values['current'][row, t]),
+                "previous": rounded(values['previous'][row, t]),
+                "delta": rounded(values['delta'][row, t]),
+                "pct": rounded(values['pct'][row, t])
+            }
+        members.append(member)
+
+    return jsonify({
+        "data_version": cube['data_version'],
+        "dimension": column,
+        "metric": metric,
+        "month": month.strftime('%Y-%m'),
+        "members": members
+    })
+
+@app.route('/forecast/scenario', methods=['POST'])
+@app.route('/d/<dataset_id>/forecast/scenario', methods=['POST'])
+def forecast_scenario():
+    """
+    What-if forecast. Expects JSON like
+    {"shocks": [{"dimension": "medium", "value": "Online", "type": "multiplicative", "factor": 1.15},
+                {"dimension": "location", "value": "Western Australia", "factor": 2, "start": "2021-06"}],
+     "group_by": "location"}
+    and returns the baseline and scenario totals per forecast month (plus per-member totals if group_by is set).
+    """
+    dataset = current_dataset()
+    df = dataset.df
+    if not isinstance(df, pd.DataFrame) or df.empty:
+        return jsonify({"error": "Data not loaded or available for forecasting."}), 500
+
+    body = request.get_json(silent=True) or {}
+    shocks = body.get('shocks', [])
+    if not isinstance(shocks, list) or not all(isinstance(shock, dict) for shock in shocks):
+        return jsonify({"error": "'shocks' must be a list of objects."}), 400
+
+    try:
+        base = get_scenario_base(dataset)
+    except Exception as e:
+        return jsonify({"error": f"An error occurred while preparing the forecast: {e}"}), 500
+
+    try:
+        scenario = apply_scenario(base, shocks)
+        group_by = resolve_dimension(body['group_by']) if body.get('group_by') else None
+    except (ValueError, TypeError, KeyError) as e:
+        return jsonify({"error": f"Invalid scenario: {e}"}), 400
+
+    baseline_totals = base['baseline'].sum(axis=0)
+    scenario_totals = scenario.sum(axis=0)
+    result = {
+        "data_version": base['data_version'],
+        "model": base['model'],
+        "periods": base['periods'].strftime('%Y-%m').tolist(),
+        "baseline": baseline_totals.round(2).tolist(),
+        "scenario": scenario_totals.round(2).tolist(),
+        "delta": ((scenario_totals - baseline_totals).round(2) + 0.0).tolist(), # + 0.0 turns -0.0 into 0.0
+        "total_baseline": round(float(baseline_totals.sum()), 2),
+        "total_scenario": round(float(scenario_totals.sum()), 2)
+    }
+    if group_by:
+        members, member_codes = np.unique(base['cells'][group_by], return_inverse=True)
+        baseline_by_member = np.bincount(member_codes, weights=base['baseline'].sum(axis=1), minlength=len(members))
+        scenario_by_member = np.bincount(member_codes, weights=scenario.sum(axis=1), minlength=len(members))
+        result["breakdown"] = {
+            str(member): {"baseline": round(float(b), 2), "scenario": round(float(s), 2)}
+            for member, b, s in zip(members, baseline_by_member, scenario_by_member)
+        }
+    return jsonify(result)
+
 @app.route('/chart/sales_by_location_map')
+@app.route('/d/<dataset_id>/chart/sales_by_location_map')
 def sales_by_location_map():
     """
     Generates a choropleth map of Australia showing total revenue by state.
     Includes formatted revenue values in tooltips and popups.
     Allows for dynamic height and width modifications via URL parameters.
     """
+    dataset = current_dataset()
+    df = dataset.df
+    geojson_data = dataset.geojson_data
     if df.empty or geojson_data is None:
         return "<div>Error: Data or GeoJSON not loaded or available for Sales Location Map.</div>", 500
 
@@ -727,7 +2033,7 @@ def sales_by_location_map():
     if 'Sales Location' not in df.columns:
         return "<div>Error: 'Sales Location' column not found in data. Cannot generate map.</div>", 500
 
-    sales_by_location = df.groupby('Sales Location')['Total Revenue'].sum().reset_index()
+    sales_by_location = aggregate_location_revenue(df)
 
     # Function to format revenue for readability (K for thousands, M for millions)
     def format_revenue_for_map(revenue):
@@ -811,6 +2117,467 @@ def sales_by_location_map():
     map_html = australia_map._repr_html_()
     return render_chart_template(map_html, "Sales Distribution by Location")
 
+@app.route('/geo/cells')
+@app.route('/d/<dataset_id>/geo/cells')
+def geo_cells():
+    """
+    Store-level sales binned into grid cells for a map view: ?zoom=<0-18>&bbox=west,south,east,north.
+    Returns column arrays (south/west/north/east bounds, centroid, count, revenue) for the
+    non-empty cells in the box only, so the payload depends on the view, not on the number of stores.
+    """
+    dataset = current_dataset()
+    df = dataset.df
+    if not isinstance(df, pd.DataFrame) or df.empty:
+        return jsonify({"error": "Data not loaded or available for the store map."}), 500
+
+    try:
+        zoom = int(request.args.get('zoom', 4))
+        if not 0 <= zoom <= GRID_MAX_ZOOM:
+            raise ValueError(f"zoom must be between 0 and {GRID_MAX_ZOOM}")
+        west, south, east, north = (float(v) for v in request.args.get('bbox', '-180,-85,180,85').split(','))
+        if south > north:
+            raise ValueError("south must not be greater than north")
+        west, east = wrap_longitudes(west, east)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid zoom or bbox: {e}"}), 400
+
+    cells = get_grid_cells(dataset, zoom)
+    if cells is None:
+        return jsonify({
+            "zoom": zoom,
+            "cells": {column: [] for column in ['south', 'west', 'north', 'east', 'center_lat', 'center_lon', 'count', 'revenue']},
+            "message": f"No '{POINT_LAT_COLUMN}'/'{POINT_LON_COLUMN}' columns in the data."
+        })
+    table = cells_to_table(cells_in_bbox(cells, zoom, west, south, east, north), zoom)
+    return jsonify({"zoom": zoom, "cells": table.round(6).to_dict('list')})
+
+@app.route('/chart/store_map')
+@app.route('/d/<dataset_id>/chart/store_map')
+def store_map():
+    """
+    Map of store-level sales. Instead of one marker per store, the browser requests
+    grid cells for the current view from /geo/cells and redraws them on pan/zoom.
+    """
+    dataset = current_dataset()
+    df = dataset.df
+    if not isinstance(df, pd.DataFrame) or df.empty:
+        return "<div>Error: Data not loaded or available for Store Map.</div>", 500
+
+    store_map_view = folium.Map(
+        location=[-25, 135],
+        zoom_start=4,
+        control_scale=True,
+        height=request.args.get('height', '100%'),
+        width=request.args.get('width', '100%')
+    )
+    GridCellLayer(f"/d/{dataset.id}/geo/cells", [nestle_colors['map_color_low'], nestle_colors['map_color_mid'], nestle_colors['map_color_high']]).add_to(store_map_view)
+
+    map_html = store_map_view._repr_html_()
+    return render_chart_template(map_html, "Store Sales Map")
+
+
+# --- Data Export (streamed CSV / Parquet / XLSX) ---
+EXPORT_CHUNK_ROWS = 50_000 # Rows serialized per chunk, so exports never hold the whole file in memory
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+}
+DERIVED_COLUMNS = ['Month', 'Year', 'Month_Year'] # Helper columns added by add_derived_columns(), not part of the raw rows
+
+# Query string parameter -> column it filters (repeat a parameter to allow several values)
+FILTER_COLUMNS = {
+    'product': 'Product Name',
+    'location': 'Sales Location',
+    'medium': 'Sales Medium'
+}
+
+def filter_sales_data(frame, args):
+    """
+    Applies the optional product/location/medium and start/end date filters
+    from the query string. Raises ValueError for unparseable dates.
+    """
+    mask = pd.Series(True, index=frame.index)
+    for param, column in FILTER_COLUMNS.items():
+        values = args.getlist(param)
+        if values:
+            mask &= frame[column].isin(values)
+    if args.get('start'):
+        mask &= frame['Date'] >= pd.to_datetime(args['start'])
+    if args.get('end'):
+        mask &= frame['Date'] <= pd.to_datetime(args['end'])
+    return frame[mask]
+
+def iter_frame_chunks(frame):
+    """Yields consecutive row slices of at most EXPORT_CHUNK_ROWS rows."""
+    for start in range(0, len(frame), EXPORT_CHUNK_ROWS):
+        yield frame.iloc[start:start + EXPORT_CHUNK_ROWS]
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that keeps written bytes until a generator drains them."""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+class _QueueSink(io.RawIOBase):
+    """
+    Write-only, non-seekable file object that hands every write to a bounded queue.
+    Used so a library that writes a whole file in one call (openpyxl's save) can be
+    streamed by a generator on another thread. Writes block while the client is slow.
+    """
+
+    def __init__(self, chunk_queue, cancelled):
+        super().__init__()
+        self.chunk_queue = chunk_queue
+        self.cancelled = cancelled
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        while True:
+            if self.cancelled.is_set():
+                raise OSError("Export cancelled by client.")
+            try:
+                self.chunk_queue.put(data, timeout=1)
+                break
+            except queue.Full:
+                continue
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+def stream_csv(frame):
+    """Yields the frame as CSV text, one chunk of rows at a time."""
+    if frame.empty:
+        yield frame.to_csv(index=False)
+        return
+    for i, chunk in enumerate(iter_frame_chunks(frame)):
+        yield chunk.to_csv(index=False, header=(i == 0))
+
+def stream_parquet(frame):
+    """Yields the frame as Parquet bytes, writing one row group per chunk."""
+    sink = _ChunkSink()
+    schema = pa.Schema.from_pandas(frame, preserve_index=False)
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        for chunk in iter_frame_chunks(frame):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain() # Parquet footer
+
+def stream_xlsx(frame, sheet_title='Export'):
+    """
+    Yields the frame as an XLSX workbook. Rows go through openpyxl's write-only
+    worksheet (spooled to a temporary file, not kept in memory), and the zip
+    container is streamed from a worker thread while openpyxl writes it.
+    """
+    chunk_queue = queue.Queue(maxsize=16)
+    cancelled = threading.Event()
+    done = object()
+
+    def build_workbook():
+        try:
+            workbook = Workbook(write_only=True)
+            worksheet = workbook.create_sheet(title=sheet_title)
+            worksheet.append(list(frame.columns))
+            for chunk in iter_frame_chunks(frame):
+                # openpyxl cannot write NaN/NaT, so blank them out
+                chunk = chunk.astype(object).where(chunk.notna(), None)
+                for row in chunk.itertuples(index=False, name=None):
+                    worksheet.append(row)
+            workbook.save(_QueueSink(chunk_queue, cancelled))
+            chunk_queue.put(done)
+        except Exception as e:
+            if not cancelled.is_set():
+                chunk_queue.put(e)
+
+    worker = threading.Thread(target=build_workbook, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item = chunk_queue.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        cancelled.set()
+
+def export_response(frame, fmt, filename):
+    """Wraps the streaming generator for the requested format in a download Response."""
+    if fmt == 'csv':
+        body = stream_csv(frame)
+    elif fmt == 'parquet':
+        body = stream_parquet(frame)
+    else:
+        body = stream_xlsx(frame, sheet_title=filename[:31])
+    return Response(body, mimetype=EXPORT_MIMETYPES[fmt], headers={
+        'Content-Disposition': f'attachment; filename="{filename}.{fmt}"'
+    })
+
+def check_export_format(fmt):
+    """Returns an error response for unsupported/unavailable formats, or None if fmt is usable."""
+    if fmt not in EXPORT_MIMETYPES:
+        return jsonify({"error": f"Unsupported export format '{fmt}'. Use one of: {', '.join(EXPORT_MIMETYPES)}."}), 400
+    if fmt == 'parquet' and pa is None:
+        return jsonify({"error": "Parquet export requires the 'pyarrow' package."}), 501
+    return None
+
+@app.route('/export')
+@app.route('/d/<dataset_id>/export')
+def export_index():
+    """Lists the exportable tables, formats and filters of the dataset in the URL."""
+    prefix = f"/d/{g.dataset_id}"
+    with_points = has_coordinates(current_dataset().df)
+    return jsonify({
+        "dataset": g.dataset_id,
+        "formats": list(EXPORT_MIMETYPES),
+        "rows": f"{prefix}/export/rows.<format>",
+        "aggregates": {name: f"{prefix}/export/aggregate/{name}.<format>" for name in CHART_AGGREGATES
+                       if name != 'store_cells' or with_points}, # Store cells need coordinates
+        "filters": list(FILTER_COLUMNS) + ['start', 'end']
+    })
+
+@app.route('/export/rows.<fmt>')
+@app.route('/d/<dataset_id>/export/rows.<fmt>')
+def export_rows(fmt):
+    """Streams the (optionally filtered) raw sales rows."""
+    error = check_export_format(fmt)
+    if error:
+        return error
+    dataset = current_dataset()
+    df = dataset.df
+    if not isinstance(df, pd.DataFrame) or df.empty:
+        return jsonify({"error": "Data not loaded or available for export."}), 500
+
+    try:
+        rows = filter_sales_data(df, request.args)
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": f"Invalid filter: {e}"}), 400
+    rows = rows.drop(columns=[c for c in DERIVED_COLUMNS if c in rows.columns])
+    return export_response(rows, fmt, f'{dataset.id}_sales_rows')
+
+@app.route('/export/aggregate/<name>.<fmt>')
+@app.route('/d/<dataset_id>/export/aggregate/<name>.<fmt>')
+def export_aggregate(name, fmt):
+    """Streams the aggregate table behind one of the charts, computed on the (optionally filtered) rows."""
+    error = check_export_format(fmt)
+    if error:
+        return error
+    if name not in CHART_AGGREGATES:
+        return jsonify({"error": f"Unknown aggregate '{name}'. Use one of: {', '.join(CHART_AGGREGATES)}."}), 404
+    dataset = current_dataset()
+    df = dataset.df
+    if not isinstance(df, pd.DataFrame) or df.empty:
+        return jsonify({"error": "Data not loaded or available for export."}), 500
+    if name == 'store_cells' and not has_coordinates(df):
+        return jsonify({"error": f"Dataset '{dataset.id}' has no {POINT_LAT_COLUMN}/{POINT_LON_COLUMN} columns, so it has no store cells."}), 404
+
+    try:
+        rows = filter_sales_data(df, request.args)
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": f"Invalid filter: {e}"}), 400
+    try:
+        table = CHART_AGGREGATES[name](rows)
+    except KeyError as ke:
+        return jsonify({"error": f"Missing column for aggregate '{name}': {ke}"}), 500
+    return export_response(table, fmt, f'{dataset.id}_{name}')
+
+@app.route('/events')
+@app.route('/d/<dataset_id>/events')
+def data_update_events():
+    """
+    Server-Sent Events stream of data updates of the dataset in the URL. Each event
+    carries the new data version, the KPIs and the IDs of the charts that changed. Clients
+    resume from the Last-Event-ID header (sent automatically by EventSource) or ?since=<version>.
+    """
+    updates = current_dataset().updates
+    try:
+        seen_version = int(request.headers.get('Last-Event-ID') or request.args.get('since') or updates.version)
+    except ValueError:
+        return jsonify({"error": "'since' must be an integer data version."}), 400
+    if seen_version > updates.version:
+        # Version from before a server restart (versions start again at 1): send the current update right away
+        seen_version = 0
+
+    def stream():
+        version = seen_version
+        yield "retry: 5000\n\n" # Reconnect delay for EventSource, in milliseconds
+        while True:
+            update = updates.wait_for_update(version, timeout=SSE_KEEPALIVE_SECONDS)
+            if update is None:
+                yield ": keepalive\n\n"
+            else:
+                version, message = update
+                yield message
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no' # Stop nginx from buffering the stream
+    })
+
+DATA_APPEND_TOKEN = os.environ.get('DATA_APPEND_TOKEN') # Shared secret for /data/append; appends are disabled when unset
+REQUIRED_ROW_COLUMNS = ['Sales ID', 'Date'] + SALES_DIMENSIONS # Appended rows must have a value in each of these
+
+def cast_rows(rows, dtypes):
+    """
+    Casts appended rows to the loaded rows' dtypes, so they neither turn a column into a
+    mixed object column (which the columnar cache cannot write) nor counts into floats.
+    Raises ValueError/TypeError when a value does not fit its column.
+    """
+    for column, dtype in dtypes.items():
+        if pd.api.types.is_integer_dtype(dtype):
+            values = pd.to_numeric(rows[column])
+            if (values % 1 != 0).any():
+                raise ValueError(f"'{column}' must be a whole number")
+            rows[column] = values.astype(dtype)
+        elif pd.api.types.is_float_dtype(dtype):
+            rows[column] = pd.to_numeric(rows[column]).astype(dtype)
+        elif pd.api.types.is_datetime64_any_dtype(dtype):
+            dates = pd.to_datetime(rows[column])
+            rows[column] = (dates.dt.tz_localize(None) if dates.dt.tz is not None else dates).astype(dtype)
+        else: # Text: IDs and dimensions
+            rows[column] = rows[column].map(str, na_action='ignore').astype(dtype)
+    return rows
+
+@app.route('/data/append', methods=['POST'])
+@app.route('/d/<dataset_id>/data/append', methods=['POST'])
+def append_sales_data():
+    """
+    Appends sales rows to the in-memory data (JSON body {"rows": [{...}, ...]} with the
+    same columns as the Excel file) and publishes the update. Sketches are updated with
+    the new rows only. Appended rows are not written back to the Excel file (only to the
+    columnar cache when the dataset is evicted), so they are dropped the next time the
+    file itself changes and is reloaded.
+    """
+    if not DATA_APPEND_TOKEN:
+        return jsonify({"error": "Appending data is disabled. Set DATA_APPEND_TOKEN to enable it."}), 403
+    if request.headers.get('X-Append-Token') != DATA_APPEND_TOKEN:
+        return jsonify({"error": "Invalid or missing X-Append-Token header."}), 403
+    dataset = current_dataset()
+    df = dataset.df
+    if not isinstance(df, pd.DataFrame) or df.empty:
+        return jsonify({"error": "Data not loaded; nothing to append to."}), 500
+
+    rows = (request.get_json(silent=True) or {}).get('rows')
+    if not isinstance(rows, list) or not rows:
+        return jsonify({"error": "'rows' must be a non-empty list of objects."}), 400
+
+    raw_columns = [c for c in df.columns if c not in DERIVED_COLUMNS]
+    try:
+        new_rows = pd.DataFrame(rows)
+        missing = [c for c in raw_columns if c not in new_rows.columns]
+        if missing:
+            return jsonify({"error": f"Missing columns: {', '.join(missing)}"}), 400
+        new_rows = new_rows[raw_columns]
+        blank = [c for c in REQUIRED_ROW_COLUMNS if c in new_rows.columns and new_rows[c].isna().any()]
+        if blank:
+            return jsonify({"error": f"Rows with blank values in: {', '.join(blank)}"}), 400
+        new_rows = add_derived_columns(cast_rows(new_rows, df[raw_columns].dtypes))
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": f"Invalid rows: {e}"}), 400
+
+    while True:
+        with dataset.append_lock:
+            if not dataset.evicted:
+                # publish_data_update only swaps the combined rows in once their derived state is built
+                try:
+                    publish_data_update(dataset, pd.concat([dataset.df, new_rows], ignore_index=True), new_rows)
+                except Exception as e:
+                    return jsonify({"error": f"Could not apply the appended rows: {e}"}), 500
+                dataset.frame_bytes += int(new_rows.memory_usage(deep=True).sum())
+                dataset.appended = True
+                break
+        dataset = dataset_cache.get(dataset.id) # Evicted (rows saved) since the request started: reload it
+    dataset_cache.refresh_size(dataset)
+    return jsonify({"appended": len(new_rows), "data_version": dataset.data_version})
+
+# --- On-demand request profiling ---
+# Enabled per request with a signed token (X-Profile header or ?profile=, see profiling.py)
+# when PROFILE_SECRET is set, and/or for 1 in PROFILE_SAMPLE_RATE requests. With neither
+# configured no hooks are registered, so requests pay nothing for this feature.
+PROFILE_SECRET = os.environ.get('PROFILE_SECRET')
+PROFILE_SAMPLE_RATE = int(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(BASE_DIR, 'profiles'))
+PROFILE_MAX_PROFILES = int(os.environ.get('PROFILE_MAX_PROFILES', '50')) # Older profiles are deleted
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '5'))
+
+if PROFILE_SECRET or PROFILE_SAMPLE_RATE > 0:
+    profile_request_counter = itertools.count(1)
+
+    @app.before_request
+    def start_request_profile():
+        token = request.headers.get('X-Profile') or request.args.get('profile')
+        signed = bool(PROFILE_SECRET and token and profiling.verify_token(PROFILE_SECRET, request.path, token))
+        sampled = PROFILE_SAMPLE_RATE > 0 and next(profile_request_counter) % PROFILE_SAMPLE_RATE == 0
+        if signed or sampled:
+            g.profiler = profiling.SamplingProfiler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000).start()
+            g.profile_trigger = 'signed' if signed else 'sampled'
+
+    @app.after_request
+    def finish_request_profile(response):
+        # Streamed bodies (exports, /events) are produced after this point and are not covered
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.stop()
+            try:
+                profile_id = profiling.save_profile(profiler, PROFILE_DIR, {
+                    "method": request.method,
+                    "path": request.full_path.rstrip('?'),
+                    "endpoint": request.endpoint,
+                    "status": response.status_code,
+                    "trigger": g.pop('profile_trigger', None)
+                }, max_profiles=PROFILE_MAX_PROFILES)
+                response.headers['X-Profile-Id'] = profile_id
+                print(f"Saved request profile {profile_id} for {request.path} in {PROFILE_DIR}")
+            except OSError as e:
+                print(f"Could not save request profile: {e}")
+        return response
+
+    @app.teardown_request
+    def stop_request_profile(exc):
+        # Requests that failed before after_request still stop their sampler thread
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.stop()
+
+@app.route('/datasets')
+def list_datasets():
+    """Configured datasets, which of them are loaded and how much of the memory budget they use."""
+    return jsonify(dataset_cache.stats())
+
+# --- Startup: load the default dataset (with its derived state), then watch the loaded files for changes ---
+if not IS_WORKER_PROCESS:
+    with app.app_context():
+        dataset_cache.get(DEFAULT_DATASET_ID)
+if DATA_WATCH_INTERVAL > 0 and not IS_WORKER_PROCESS:
+    threading.Thread(target=watch_data_file, name='data-file-watcher', daemon=True).start()
 
 
 
@@ -66,35 +66,76 @@ document.addEventListener('DOMContentLoaded', () => {
   resizeObserver.observe(carouselContainer);
 });
 
+const KPI_ELEMENT_IDS = {
+  total_revenue: 'kpi-total-revenue',
+  average_revenue: 'kpi-average-revenue',
+  total_unique_products: 'kpi-total-products',
+  total_sales_count: 'kpi-total-sales',
+  max_revenue: 'max-revenue',
+  min_revenue: 'min-revenue'
+};
+
+// Writes KPI values into the header boxes, or the fallback text for every box
+function renderKpis(data, fallbackText) {
+  Object.entries(KPI_ELEMENT_IDS).forEach(([key, elementId]) => {
+    const element = document.getElementById(elementId);
+    if (element) {
+      element.innerText = data ? data[key] : fallbackText;
+    }
+  });
+}
+
+// Prefixes a route with the dashboard's dataset ('/d/<dataset_id>', empty for the default dataset)
+function datasetUrl(path) {
+  return (document.body.dataset.datasetPrefix || '') + path;
+}
+
+// Reloads only the chart iframes whose /chart/<id> route is in changedCharts
+function refreshCharts(changedCharts, version) {
+  document.querySelectorAll('iframe').forEach(iframe => {
+    const src = iframe.getAttribute('src');
+    if (!src) {
+      return;
+    }
+    const url = new URL(src, window.location.origin);
+    const match = url.pathname.match(/\/chart\/([^/]+)$/);
+    if (match && changedCharts.includes(match[1])) {
+      url.searchParams.set('v', version); // Bypass any cached copy of the old chart
+      iframe.setAttribute('src', url.pathname + url.search);
+    }
+  });
+}
+
+// Subscribes to server-pushed data updates instead of polling every chart
+function subscribeToDataUpdates(sinceVersion) {
+  if (!window.EventSource) {
+    return;
+  }
+  const source = new EventSource(datasetUrl(`/events?since=${sinceVersion}`));
+  source.addEventListener('update', event => {
+    const update = JSON.parse(event.data);
+    if (update.kpis && !update.kpis.error) {
+      renderKpis(update.kpis);
+    }
+    refreshCharts(update.changed_charts || [], update.version);
+  });
+}
+
 document.addEventListener('DOMContentLoaded', function () {
-  fetch('/kpi_data')
+  fetch(datasetUrl('/kpi_data'))
     .then(response => response.json())
     .then(data => {
       if (data.error) {
         console.error('Error fetching KPI data:', data.error);
-        document.getElementById('kpi-total-revenue').innerText = 'N/A';
-        document.getElementById('kpi-average-revenue').innerText = 'N/A';
-        document.getElementById('kpi-total-products').innerText = 'N/A';
-        document.getElementById('kpi-total-sales').innerText = 'N/A';
-        document.getElementById('max-revenue').innerText = 'N/A';
-        document.getElementById('min-revenue').innerText = 'N/A';
+        renderKpis(null, 'N/A');
       } else {
-        document.getElementById('kpi-total-revenue').innerText = data.total_revenue;
-        document.getElementById('kpi-average-revenue').innerText = data.average_revenue;
-        document.getElementById('kpi-total-products').innerText = data.total_unique_products;
-        document.getElementById('kpi-total-sales').innerText = data.total_sales_count;
-        document.getElementById('max-revenue').innerText = data.max_revenue;
-        document.getElementById('min-revenue').innerText = data.min_revenue;
+        renderKpis(data);
+        subscribeToDataUpdates(data.data_version);
       }
     })
     .catch(error => {
       console.error('Network or parsing error:', error);
-      document.getElementById('kpi-total-revenue').innerText = 'Error';
-      document.getElementById('kpi-average-revenue').innerText = 'Error';
-      document.getElementById('kpi-total-products').innerText = 'Error';
-      document.getElementById('kpi-total-sales').innerText = 'Error';
-      document.getElementById('max-revenue').innerText = 'Error';
-      document.getElementById('min-revenue').innerText = 'Error';
+      renderKpis(null, 'Error');
     });
 });
 
@@ -299,7 +340,7 @@ function updateContent(index) {
     // Update iframe src and style
     const iframeElement = document.getElementById('analytics-iframe');
     if (iframeElement) {
-      iframeElement.src = selectedData.iframeSrc;
+      iframeElement.src = datasetUrl(selectedData.iframeSrc);
       iframeElement.style.transform = selectedData.iframeSize; // Adjust scale if needed
     } else {
       console.error("Iframe element not found.");
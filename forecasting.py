@@ -0,0 +1,196 @@
+# Forecast model fitting and rolling-origin backtesting for the monthly revenue series.
+# Kept separate from app.py so process-pool workers can import it without loading the dashboard data.
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from statsmodels.tsa.statespace.sarimax import SARIMAX
+from statsmodels.tsa.holtwinters import ExponentialSmoothing
+
+SEASONAL_PERIODS = 12 # Monthly data, yearly seasonality
+
+# Candidate models evaluated by the backtest
+CANDIDATE_MODELS = [
+    {'kind': 'seasonal_naive'},
+    {'kind': 'ets', 'trend': None, 'damped_trend': False, 'seasonal': 'add'},
+    {'kind': 'ets', 'trend': None, 'damped_trend': False, 'seasonal': 'mul'},
+    {'kind': 'ets', 'trend': 'add', 'damped_trend': False, 'seasonal': 'add'},
+    {'kind': 'ets', 'trend': 'add', 'damped_trend': True, 'seasonal': 'add'},
+    {'kind': 'ets', 'trend': 'add', 'damped_trend': True, 'seasonal': 'mul'},
+    {'kind': 'sarimax', 'order': [0, 1, 1], 'seasonal_order': [0, 1, 1, SEASONAL_PERIODS]},
+    {'kind': 'sarimax', 'order': [1, 1, 1], 'seasonal_order': [0, 1, 1, SEASONAL_PERIODS]},
+    {'kind': 'sarimax', 'order': [1, 0, 0], 'seasonal_order': [1, 1, 0, SEASONAL_PERIODS]},
+]
+
+# The model the forecast chart used before backtesting existed; used as the fallback
+DEFAULT_MODEL = {'kind': 'ets', 'trend': None, 'damped_trend': False, 'seasonal': 'add'}
+
+def model_name(spec):
+    """Short readable name for a model spec, e.g. 'ets(trend=add,damped,seasonal=mul)'."""
+    if spec['kind'] == 'seasonal_naive':
+        return 'seasonal_naive'
+    if spec['kind'] == 'ets':
+        parts = [f"trend={spec['trend'] or 'none'}"]
+        if spec['damped_trend']:
+            parts.append('damped')
+        parts.append(f"seasonal={spec['seasonal']}")
+        return f"ets({','.join(parts)})"
+    order = ','.join(str(v) for v in spec['order'])
+    seasonal_order = ','.join(str(v) for v in spec['seasonal_order'])
+    return f"sarimax({order})({seasonal_order})"
+
+def forecast_model(spec, series, steps):
+    """
+    Fits the model described by spec on series (a monthly pd.Series with a
+    DatetimeIndex, or a 1-D array) and returns the next `steps` values as an array.
+    """
+    values = np.asarray(series, dtype=float)
+    if spec['kind'] == 'seasonal_naive':
+        last_season = values[-SEASONAL_PERIODS:]
+        return np.resize(last_season, steps)
+
+    if not isinstance(series, pd.Series):
+        series = pd.Series(values, index=pd.date_range('2000-01-01', periods=len(values), freq='MS'))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        if spec['kind'] == 'ets':
+            model = ExponentialSmoothing(series, trend=spec['trend'], damped_trend=spec['damped_trend'],
+                                         seasonal=spec['seasonal'], seasonal_periods=SEASONAL_PERIODS)
+            results = model.fit()
+        elif spec['kind'] == 'sarimax':
+            model = SARIMAX(series, order=tuple(spec['order']), seasonal_order=tuple(spec['seasonal_order']),
+                            enforce_stationarity=False, enforce_invertibility=False)
+            results = model.fit(disp=False)
+        else:
+            raise ValueError(f"Unknown model kind: {spec['kind']}")
+        forecast = np.asarray(results.forecast(steps), dtype=float)
+    if not np.all(np.isfinite(forecast)):
+        raise ValueError("Model produced non-finite forecasts.")
+    return forecast
+
+def evaluate_fold(spec, train, actual):
+    """Fits on train, forecasts len(actual) steps and returns the error sums for one fold."""
+    try:
+        forecast = forecast_model(spec, train, len(actual))
+    except Exception as e:
+        return {'error': str(e)}
+    errors = actual - forecast
+    nonzero = actual != 0
+    return {
+        'n': int(len(actual)),
+        'sum_squared_error': float(np.sum(errors ** 2)),
+        'sum_abs_pct_error': float(np.sum(np.abs(errors[nonzero] / actual[nonzero]))),
+        'n_pct': int(np.count_nonzero(nonzero))
+    }
+
+def rolling_origins(n_obs, min_train, horizon, step=1):
+    """Training-set lengths for each rolling forecast origin that leaves a full horizon to test on."""
+    return list(range(min_train, n_obs - horizon + 1, step))
+
+def fold_key(spec, train, actual):
+    """Cache key of one fold: the model spec plus the exact data it is fitted and scored on."""
+    digest = hashlib.sha1(json.dumps(spec, sort_keys=True).encode())
+    digest.update(np.ascontiguousarray(train, dtype=float).tobytes())
+    digest.update(b'|')
+    digest.update(np.ascontiguousarray(actual, dtype=float).tobytes())
+    return digest.hexdigest()
+
+fold_cache_lock = threading.Lock() # Serializes cache writes between threads of one process
+
+def load_fold_cache(cache_path):
+    """Reads the per-fold result cache, or returns an empty one."""
+    try:
+        with open(cache_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_fold_cache(cache_path, cache):
+    """
+    Writes the per-fold result cache atomically. Each write goes through its own
+    temporary file, so concurrent writers (threads or processes) never clobber each other.
+    """
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with fold_cache_lock:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+def run_backtest(series, candidates=CANDIDATE_MODELS, horizon=6, min_train=2 * SEASONAL_PERIODS, step=1,
+                 cache_path=None, max_workers=None):
+    """
+    Evaluates every candidate over rolling forecast origins and returns the
+    leaderboard, best model first (lowest MAPE, then RMSE). Fold results are
+    cached by content, so rerunning after new months arrive only fits the new folds.
+    Missing folds are fitted in parallel across processes. The saved cache keeps only
+    the folds of this run, so it does not grow as the data changes.
+    """
+    values = np.asarray(series, dtype=float)
+    origins = rolling_origins(len(values), min_train, horizon, step)
+    cache = load_fold_cache(cache_path) if cache_path else {}
+
+    folds = {} # (candidate index, origin) -> cache key
+    pending = {} # cache key -> (spec, train, actual)
+    for i, spec in enumerate(candidates):
+        for origin in origins:
+            train, actual = values[:origin], values[origin:origin + horizon]
+            key = fold_key(spec, train, actual)
+            folds[(i, origin)] = key
+            if key not in cache:
+                pending[key] = (spec, train, actual)
+
+    if pending:
+        if max_workers == 1:
+            for key, args in pending.items():
+                cache[key] = evaluate_fold(*args)
+        else:
+            # 'spawn', not Linux's default fork: forking the threaded web server can copy a
+            # lock held by another thread (e.g. stdout's) into the child and deadlock it
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = {key: executor.submit(evaluate_fold, *args) for key, args in pending.items()}
+                for key, future in futures.items():
+                    cache[key] = future.result()
+
+    used_keys = set(folds.values())
+    if cache_path and (pending or len(cache) != len(used_keys)):
+        save_fold_cache(cache_path, {key: cache[key] for key in used_keys})
+
+    leaderboard = []
+    for i, spec in enumerate(candidates):
+        results = [cache[folds[(i, origin)]] for origin in origins]
+        failed = [r for r in results if 'error' in r]
+        scored = [r for r in results if 'error' not in r]
+        entry = {
+            'model': model_name(spec),
+            'spec': spec,
+            'folds': len(scored),
+            'failed_folds': len(failed),
+            'mape': None,
+            'rmse': None
+        }
+        # Only models that fit on every origin are comparable
+        if scored and not failed:
+            n_pct = sum(r['n_pct'] for r in scored)
+            entry['mape'] = 100 * sum(r['sum_abs_pct_error'] for r in scored) / n_pct if n_pct else None
+            entry['rmse'] = float(np.sqrt(sum(r['sum_squared_error'] for r in scored) / sum(r['n'] for r in scored)))
+        leaderboard.append(entry)
+
+    leaderboard.sort(key=lambda e: (e['mape'] is None, e['mape'] if e['mape'] is not None else 0,
+                                    e['rmse'] if e['rmse'] is not None else 0))
+    return {
+        'horizon': horizon,
+        'origins': len(origins),
+        'leaderboard': leaderboard
+    }
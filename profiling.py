@@ -0,0 +1,221 @@
+# Low-overhead sampling profiler for individual requests, with flame-graph artifacts.
+# Run `python profiling.py sign <path> [minutes]` to create a signed X-Profile token for a route.
+import hashlib
+import hmac
+import html
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter
+
+# Library (matched against frame file paths) -> phase reported in the summary.
+# A sample is charged to the outermost library frame below the request plumbing
+# (see sample_phase), so e.g. pandas work done inside Altair's to_html counts as 'altair'.
+PHASE_LIBRARIES = [
+    ('altair', 'altair'),
+    ('vl_convert', 'altair'),
+    ('folium', 'folium'),
+    ('branca', 'folium'),
+    ('plotly', 'plotly'),
+    ('statsmodels', 'statsmodels'),
+    ('pandas', 'pandas'),
+    ('numpy', 'numpy'),
+    ('jinja2', 'templates'),
+    ('werkzeug', 'server'),
+    ('flask', 'server'),
+]
+
+def sign_token(secret, path, expires):
+    """Token authorizing a profile of `path` until the unix time `expires`: '<expires>.<hex hmac>'."""
+    signature = hmac.new(secret.encode(), f"{path}\n{int(expires)}".encode(), hashlib.sha256).hexdigest()
+    return f"{int(expires)}.{signature}"
+
+def verify_token(secret, path, token):
+    """True if token was signed for this path with this secret and has not expired."""
+    try:
+        expires = int(token.split('.', 1)[0])
+    except ValueError:
+        return False
+    if expires < time.time():
+        return False
+    # Bytes, since compare_digest raises TypeError for non-ASCII str (tokens come from any client)
+    return hmac.compare_digest(sign_token(secret, path, expires).encode(), token.encode())
+
+def frame_label(code):
+    """Readable frame name used in the collapsed stacks, e.g. 'kpi_data (app.py:877)'."""
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def frame_phase(code):
+    """Phase of the library a frame belongs to, or None for application code."""
+    path = code.co_filename.replace('\\', '/')
+    if 'site-packages' not in path and 'dist-packages' not in path:
+        return None
+    for library, phase in PHASE_LIBRARIES:
+        if f"/{library}/" in path:
+            return phase
+    return None
+
+def sample_phase(stack):
+    """
+    Phase of one sampled stack (root first): the outermost library below the
+    Flask/Werkzeug request plumbing, 'app' for our own code, 'server' if the
+    sample was taken in the plumbing itself.
+    """
+    phases = [frame_phase(code) for code in stack]
+    last_server = max((i for i, phase in enumerate(phases) if phase == 'server'), default=-1)
+    if last_server == len(phases) - 1:
+        return 'server'
+    return next((phase for phase in phases[last_server + 1:] if phase is not None), 'app')
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread every `interval` seconds from a background
+    thread. Nothing is installed on the profiled thread itself (no sys.setprofile),
+    so the profiled code runs at normal speed apart from the GIL the sampler briefly holds.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter() # tuple of code objects (root first) -> sample count
+        self.started = None
+        self.duration = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self.duration is None:
+            self._stopped.set()
+            self._thread.join()
+            self.duration = time.perf_counter() - self.started
+        return self.duration
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            if stack:
+                self.samples[tuple(reversed(stack))] += 1
+
+    def collapsed_stacks(self):
+        """Stacks in the 'root;caller;callee count' format read by flamegraph.pl and speedscope."""
+        lines = [f"{';'.join(frame_label(code) for code in stack)} {count}" for stack, count in self.samples.most_common()]
+        return '\n'.join(lines) + '\n'
+
+    def phase_summary(self):
+        """Share of samples (and estimated milliseconds) spent in each phase."""
+        phases = Counter()
+        for stack, count in self.samples.items():
+            phases[sample_phase(stack)] += count
+        total = sum(phases.values())
+        duration_ms = (self.duration or 0) * 1000
+        return {
+            phase: {
+                'samples': count,
+                'percent': round(100 * count / total, 1),
+                'ms': round(duration_ms * count / total, 1)
+            }
+            for phase, count in phases.most_common()
+        }
+
+    def flame_graph_svg(self, width=1200, row_height=16):
+        """Renders the samples as a simple self-contained SVG flame graph (root at the bottom)."""
+        tree = {'children': {}, 'count': 0}
+        for stack, count in self.samples.items():
+            node = tree
+            node['count'] += count
+            for code in stack:
+                node = node['children'].setdefault(frame_label(code), {'children': {}, 'count': 0})
+                node['count'] += count
+
+        def depth(node):
+            return 1 + max((depth(child) for child in node['children'].values()), default=0)
+
+        rows = depth(tree) - 1
+        height = max(rows, 1) * row_height
+        total = max(tree['count'], 1)
+        rects = []
+
+        def draw(node, x, level):
+            for label, child in sorted(node['children'].items()):
+                w = width * child['count'] / total
+                y = height - (level + 1) * row_height
+                hue = 20 + zlib.crc32(label.encode()) % 40 # Stable warm colour per frame
+                title = html.escape(f"{label}: {child['count']} samples ({100 * child['count'] / total:.1f}%)")
+                text = html.escape(label[:int(w / 7)]) if w > 35 else ''
+                rects.append(
+                    f'<g><title>{title}</title><rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{row_height - 1}" '
+                    f'fill="hsl({hue},85%,60%)"/><text x="{x + 3:.1f}" y="{y + row_height - 4}" font-size="11" '
+                    f'font-family="monospace">{text}</text></g>'
+                )
+                draw(child, x, level + 1)
+                x += w
+
+        draw(tree, 0.0, 0)
+        return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+                f'viewBox="0 0 {width} {height}">{"".join(rects)}</svg>\n')
+
+def save_profile(profiler, directory, metadata, max_profiles=50):
+    """
+    Writes <id>.collapsed, <id>.svg and <id>.json (phase summary + request metadata)
+    to directory, deletes the oldest profiles beyond max_profiles and returns the id.
+    """
+    os.makedirs(directory, exist_ok=True)
+    profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    base_path = os.path.join(directory, profile_id)
+    with open(base_path + '.collapsed', 'w') as f:
+        f.write(profiler.collapsed_stacks())
+    with open(base_path + '.svg', 'w') as f:
+        f.write(profiler.flame_graph_svg())
+    summary = dict(metadata)
+    summary.update({
+        'id': profile_id,
+        'duration_ms': round(profiler.duration * 1000, 1),
+        'interval_ms': profiler.interval * 1000,
+        'samples': sum(profiler.samples.values()),
+        'phases': profiler.phase_summary()
+    })
+    with open(base_path + '.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    # Retention: keep only the newest max_profiles profiles (all three files of each). Sorted
+    # by write time, since ids saved within the same second differ only in a random suffix
+    written = {}
+    for name in os.listdir(directory):
+        if name.endswith('.json'):
+            try:
+                written[name] = os.path.getmtime(os.path.join(directory, name))
+            except OSError:
+                pass # Removed by a concurrent save
+    summaries = sorted(written, key=lambda name: (written[name], name), reverse=True)
+    for name in summaries[max_profiles:]:
+        for extension in ('.json', '.collapsed', '.svg'):
+            try:
+                os.remove(os.path.join(directory, name[:-len('.json')] + extension))
+            except OSError:
+                pass
+    return profile_id
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] != 'sign':
+        print("Usage: PROFILE_SECRET=... python profiling.py sign <path> [minutes valid, default 10]")
+        sys.exit(1)
+    secret = os.environ.get('PROFILE_SECRET')
+    if not secret:
+        print("PROFILE_SECRET is not set.")
+        sys.exit(1)
+    minutes = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+    print(sign_token(secret, sys.argv[2], time.time() + minutes * 60))
@@ -0,0 +1,50 @@
+import json
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+import pytest
+
+# Before app is imported (it loads the default dataset on import): serve a small workbook
+# from a temporary directory, so the tests neither read the real data nor write cache/
+TEST_DIR = tempfile.mkdtemp(prefix='dashboard-tests-')
+os.environ['DATA_WATCH_INTERVAL'] = '0'
+os.environ['DEFAULT_DATASET'] = 'test'
+os.environ['DATASET_CACHE_DIR'] = os.path.join(TEST_DIR, 'cache')
+os.environ['DATASETS_CONFIG'] = os.path.join(TEST_DIR, 'datasets.json')
+
+
+def raw_sales_rows(dates, columns=None):
+    """One sales row per date (revenue 100, Milo, Queensland, Online) with `columns` overriding the defaults."""
+    frame = pd.DataFrame({
+        'Sales ID': [f"S{i}" for i in range(len(dates))],
+        'Date': dates,
+        'Product Name': 'Milo',
+        'Total Revenue': 100.0,
+        'Sales Location': 'Queensland',
+        'Sales Medium': 'Online',
+        'Sales Count': 1,
+        'Product Count': 1
+    })
+    for column, values in (columns or {}).items():
+        frame[column] = values
+    return frame
+
+
+workbook = os.path.join(TEST_DIR, 'sales.xlsx')
+raw_sales_rows(pd.date_range('2019-01-01', '2020-12-31', freq='W')).to_excel(workbook, index=False)
+with open(os.environ['DATASETS_CONFIG'], 'w') as f:
+    json.dump({'test': {'excel': workbook}}, f)
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def sales_frame():
+    """Factory of sales frames with the derived columns: sales_frame(dates, {column: values})."""
+    return lambda dates, columns=None: app.add_derived_columns(raw_sales_rows(dates, columns))
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
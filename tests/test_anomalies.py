@@ -0,0 +1,20 @@
+import pandas as pd
+
+import app
+
+
+def test_last_complete_month(sales_frame):
+    def daily(end):
+        return sales_frame(pd.date_range('2019-01-01', end, freq='D'))
+
+    assert app.last_complete_month(daily('2020-11-30')) == pd.Period('2020-11', freq='M')
+    assert app.last_complete_month(daily('2020-11-28')) == pd.Period('2020-11', freq='M')
+    assert app.last_complete_month(daily('2020-12-01')) == pd.Period('2020-11', freq='M')
+
+
+def test_anomaly_scan_leaves_out_partial_month(sales_frame):
+    scan = app.run_anomaly_scan(sales_frame(pd.date_range('2019-01-01', '2020-12-01', freq='D')), data_version=1)
+
+    assert scan['months'][-1] == pd.Period('2020-11', freq='M')
+    # The one-day December would otherwise be a huge drop
+    assert '2020-12' not in set(scan['anomalies']['Month'])
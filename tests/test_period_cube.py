@@ -0,0 +1,55 @@
+import types
+
+import numpy as np
+import pandas as pd
+
+import app
+
+
+def monthly_frame(sales_frame, periods=24):
+    """`periods` monthly rows from January 2019 (revenue 100, 200, ...) with a blank last 'Sales Medium' cell."""
+    return sales_frame(pd.date_range('2019-01-01', periods=periods, freq='MS'), {
+        'Product Name': (['Milo', 'Maggi'] * periods)[:periods],
+        'Total Revenue': np.arange(1, periods + 1, dtype=float) * 100,
+        'Sales Medium': ['Online'] * (periods - 1) + [None]
+    })
+
+
+def test_period_cube_keeps_rows_with_blank_dimension(sales_frame):
+    frame = monthly_frame(sales_frame)
+    cube = app.build_period_cube(frame, data_version=1)
+
+    mediums = cube['dimensions']['Sales Medium']
+    assert len(mediums['members']) == 2
+    assert pd.isna(mediums['members']).sum() == 1
+    # Every row is counted once per dimension, blank ones included
+    assert mediums['revenue'].sum() == frame['Total Revenue'].sum()
+    assert cube['dimensions']['overall']['revenue'].sum() == frame['Total Revenue'].sum()
+
+
+def test_period_comparisons_with_blank_dimension(sales_frame):
+    cube = app.build_period_cube(monthly_frame(sales_frame), data_version=1)
+    comparisons = app.period_comparisons(cube['dimensions']['overall']['revenue'], cube['months'])
+
+    # December 2020 (2400) against November 2020 (2300) and December 2019 (1200)
+    assert comparisons['mom']['delta'][0, -1] == 100
+    assert comparisons['yoy']['pct'][0, -1] == 100
+
+
+def test_growth_kpis_use_last_complete_month(sales_frame):
+    cube = app.build_period_cube(monthly_frame(sales_frame, periods=25), data_version=1)
+    kpis = app.growth_kpis(types.SimpleNamespace(period_cube=cube))
+
+    # January 2021 has a single day of data, so December 2020 (2400 against 2300) is reported
+    assert cube['last_complete_month'] == pd.Period('2020-12', freq='M')
+    assert kpis['growth_month'] == '2020-12'
+    assert kpis['mom_revenue_growth'] == '+4.3%'
+
+
+def test_yearly_growth_ends_at_last_complete_month(sales_frame):
+    cube = app.build_period_cube(monthly_frame(sales_frame, periods=26), data_version=1)
+    growth = app.yearly_growth(types.SimpleNamespace(period_cube=cube), 'Sales Location')
+
+    # 2021 only counts January (its one-day February is partial): 2500 against 1300 in January 2020
+    assert growth['Year'].tolist() == [2019, 2020, 2021]
+    assert round(growth['YoY Growth'].iloc[-1], 4) == round(2500 / 1300 - 1, 4)